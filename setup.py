@@ -20,6 +20,9 @@ setup(name='ZFSpy',
       install_requires=[
           # -*- Extra requirements: -*-
       ],
+      extras_require={
+          'vector': ['numpy'], # zfspy.vector
+      },
       entry_points="""
       # -*- Entry points: -*-
       """,
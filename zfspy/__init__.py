@@ -1,6 +1,7 @@
 import conf
 from nvpair import NVPair
-from oodict import OODict 
+from oodict import OODict, Record
+from cache import ARC, LRU
 from zpool import ZPool
 from spa import SPA, VDevLabel
 from util import *
@@ -0,0 +1,123 @@
+"""
+ZFSpy: Python bindings for ZFS
+
+Copyright (C) 2008 Chen Zheng <nkchenz@gmail.com>
+
+This file is licensed under the terms of the GNU General Public License
+version 2. This program is licensed "as is" without any warranty of any
+kind, whether express or implied.
+
+Micro benchmarks, run as
+    python -m zfspy.bench [name...]
+"""
+import sys
+import time
+import random
+import resource
+from struct import pack
+from compress import *
+from spa import BlockPtr
+
+RECORD_SIZE = 128 << 10
+
+
+def sample_data(size = RECORD_SIZE, seed = 0):
+    """
+    Text like data, lzjb gets about 2.5:1 on it
+    """
+    r = random.Random(seed)
+    words = ['zfs', 'block', 'pointer', 'dnode', ' ', '\n', 'objset', 'indirect', '0000', 'data']
+    data = []
+    n = 0
+    while n < size:
+        w = r.choice(words)
+        data.append(w)
+        n += len(w)
+    return ''.join(data)[:size]
+
+
+def timeit(func, seconds = 2):
+    """
+    Call func repeatedly for seconds, return calls per second
+    """
+    n = 0
+    start = time.time()
+    while True:
+        func()
+        n += 1
+        elapsed = time.time() - start
+        if elapsed >= seconds:
+            return n / elapsed
+
+
+def bench_lzjb_decompress():
+    data = sample_data()
+    encoded = lzjb_compress(data)
+    assert lzjb_decompress(encoded, len(data)) == data
+    rate = timeit(lambda: lzjb_decompress(encoded, len(data)))
+    print 'lzjb_decompress: %.2f MB/s (128K record, ratio %.2f)' % \
+            (rate * len(data) / 1e6, float(len(data)) / len(encoded))
+
+
+def bench_lzjb_compress():
+    data = sample_data()
+    rate = timeit(lambda: lzjb_compress(data))
+    print 'lzjb_compress: %.2f MB/s (128K record)' % (rate * len(data) / 1e6)
+
+
+def fuzz_lzjb(rounds = 2000, seed = 0):
+    """
+    Round trip random data through lzjb_compress and lzjb_decompress, small
+    alphabets give plenty of matches, 256 gives almost none. Truncated encoded
+    data must be refused, never decoded to something of the right length.
+    """
+    r = random.Random(seed)
+    for i in xrange(rounds):
+        n = r.choice([0, 1, 2, 65, 66, 67, 1000, 5000])
+        alphabet = r.choice([1, 2, 4, 16, 256])
+        data = ''.join([chr(r.randrange(alphabet)) for j in xrange(n)])
+        encoded = lzjb_compress(data)
+        assert lzjb_decompress(encoded, n) == data, (n, alphabet)
+        if n and len(encoded) > 2:
+            cut = r.randrange(1, len(encoded))
+            assert lzjb_decompress(encoded[:cut], n) != data
+    print 'fuzz_lzjb: %d round trips ok' % rounds
+
+
+def rss():
+    """
+    peak resident set size in bytes, linux reports it in KB
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss << 10
+
+
+def bench_blkptr_memory(n = 1000000):
+    """
+    Parse n distinct block pointers and keep them all, like the block pointer
+    tree of a 128G file with 128K records
+    """
+    r = random.Random(0)
+    raw = []
+    for i in xrange(1000):
+        checksum = [r.getrandbits(64) for j in range(4)]
+        raw.append(pack('=7Q24x6Q', 1 << 24 | 256, (i << 8) + (1 << 40), 0, 0, 0, 0,
+                1 << 63 | 3 << 32 | 7 << 40 | 19 << 48 | 255 << 16 | 255, 1000 + i, 1, *checksum))
+    before = rss()
+    start = time.time()
+    bps = [BlockPtr(raw[i % 1000]) for i in xrange(n)]
+    elapsed = time.time() - start
+    used = rss() - before
+    print 'blkptr_memory: %d block pointers, %d bytes each, %.0f parsed/s' % (n, used / n, n / elapsed)
+
+
+BENCHES = {
+    'lzjb_decompress': bench_lzjb_decompress,
+    'lzjb_compress': bench_lzjb_compress,
+    'fuzz_lzjb': fuzz_lzjb,
+    'blkptr_memory': bench_blkptr_memory,
+}
+
+if __name__ == '__main__':
+    names = sys.argv[1:] or sorted(BENCHES.keys())
+    for name in names:
+        BENCHES[name]()
@@ -0,0 +1,234 @@
+"""
+ZFSpy: Python bindings for ZFS
+
+Copyright (C) 2008 Chen Zheng <nkchenz@gmail.com>
+
+This file is licensed under the terms of the GNU General Public License
+version 2. This program is licensed "as is" without any warranty of any
+kind, whether express or implied.
+"""
+import threading
+from collections import OrderedDict
+import conf
+
+
+class ARC(object):
+    """
+    ARC
+        adaptive replacement cache of decompressed blocks, size limited in bytes
+
+    Blocks seen once live in t1, blocks seen again are promoted to t2. Keys
+    evicted from t1 and t2 are remembered in the ghost lists b1 and b2, a
+    miss which hits a ghost list moves the target size p of t1, so a long
+    scan only cycles through t1 and can't flush the hot metadata in t2.
+    See Megiddo and Modha, "ARC: A Self-Tuning, Low Overhead Replacement
+    Cache", this one counts bytes instead of pages.
+
+    Any object with get(key) and put(key, data) can be used as the block
+    cache of ZIO, see ZIO.set_cache
+
+    Examples:
+        >>> c = ARC(10)
+        >>> c.put('a', '1234')
+        >>> c.get('a'), c.get('b')
+        ('1234', None)
+        >>> c.hits, c.misses
+        (1, 1)
+    """
+
+    def __init__(self, size = None):
+        """
+            @size   bytes we can hold, None to follow conf.arc_size
+        """
+        self._size = size   # c
+        self.p = 0          # target bytes of t1
+        self.t1 = OrderedDict()
+        self.t2 = OrderedDict()
+        self.b1 = OrderedDict()
+        self.b2 = OrderedDict()
+        self.t1_bytes = self.t2_bytes = self.b1_bytes = self.b2_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    @property
+    def size(self):
+        if self._size is None:
+            return conf.arc_size
+        return self._size
+
+    def get(self, key):
+        """
+        Return the data cached for key, or None
+        """
+        self.lock.acquire()
+        try:
+            if key in self.t1:
+                data = self.t1.pop(key)
+                self.t1_bytes -= len(data)
+                self.t2[key] = data
+                self.t2_bytes += len(data)
+            elif key in self.t2:
+                data = self.t2.pop(key)
+                self.t2[key] = data
+            else:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return data
+        finally:
+            self.lock.release()
+
+    def put(self, key, data):
+        """
+        Cache data under key, normally after get(key) missed
+        """
+        n = len(data)
+        if n > self.size:
+            return
+        self.lock.acquire()
+        try:
+            if key in self.t1 or key in self.t2:
+                return
+            if key in self.b1:
+                # t1 was too small for it, give t1 more room
+                delta = max(n, n * self.b2_bytes / max(self.b1_bytes, 1))
+                self.p = min(self.size, self.p + delta)
+                self.b1_bytes -= self.b1.pop(key)
+                self._replace(n, False)
+                self.t2[key] = data
+                self.t2_bytes += n
+            elif key in self.b2:
+                delta = max(n, n * self.b1_bytes / max(self.b2_bytes, 1))
+                self.p = max(0, self.p - delta)
+                self.b2_bytes -= self.b2.pop(key)
+                self._replace(n, True)
+                self.t2[key] = data
+                self.t2_bytes += n
+            else:
+                self._replace(n, False)
+                self.t1[key] = data
+                self.t1_bytes += n
+            self._trim_ghosts()
+        finally:
+            self.lock.release()
+
+    def _replace(self, n, in_b2):
+        # evict from t1 or t2 to ghost lists until n more bytes fit
+        while self.t1_bytes + self.t2_bytes + n > self.size:
+            if self.t1 and (self.t1_bytes > self.p or (in_b2 and self.t1_bytes == self.p) or not self.t2):
+                key, data = self.t1.popitem(False)
+                self.t1_bytes -= len(data)
+                self.b1[key] = len(data)
+                self.b1_bytes += len(data)
+            else:
+                key, data = self.t2.popitem(False)
+                self.t2_bytes -= len(data)
+                self.b2[key] = len(data)
+                self.b2_bytes += len(data)
+            self.evictions += 1
+
+    def _trim_ghosts(self):
+        # ghosts only remember keys, but don't let them remember more than c bytes each
+        while self.b1 and self.t1_bytes + self.b1_bytes > self.size:
+            self.b1_bytes -= self.b1.popitem(False)[1]
+        while self.b2 and self.t2_bytes + self.b2_bytes > self.size:
+            self.b2_bytes -= self.b2.popitem(False)[1]
+
+    def clear(self):
+        """
+        Drop all the cached data, counters are kept
+        """
+        self.lock.acquire()
+        try:
+            for l in (self.t1, self.t2, self.b1, self.b2):
+                l.clear()
+            self.t1_bytes = self.t2_bytes = self.b1_bytes = self.b2_bytes = 0
+            self.p = 0
+        finally:
+            self.lock.release()
+
+    def __len__(self):
+        return len(self.t1) + len(self.t2)
+
+    def __repr__(self):
+        return '<ARC \'%d/%d bytes hits %d misses %d evictions %d\'>' % \
+                (self.t1_bytes + self.t2_bytes, self.size, self.hits, self.misses, self.evictions)
+
+
+class LRU(object):
+    """
+    LRU
+        least recently used cache of parsed objects, size limited in entries
+
+    Examples:
+        >>> c = LRU(2)
+        >>> c.put(1, 'a'); c.put(2, 'b'); c.get(1)
+        'a'
+        >>> c.put(3, 'c')
+        >>> c.get(2), c.get(3), len(c)
+        (None, 'c', 2)
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.items = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, default = None):
+        """
+        Return the value cached for key, or default
+        """
+        self.lock.acquire()
+        try:
+            if key not in self.items:
+                self.misses += 1
+                return default
+            value = self.items.pop(key)
+            self.items[key] = value
+            self.hits += 1
+            return value
+        finally:
+            self.lock.release()
+
+    def put(self, key, value):
+        """
+        Cache value under key, evict the least recently used ones if full
+        """
+        if self.size <= 0:
+            return
+        self.lock.acquire()
+        try:
+            self.items.pop(key, None)
+            self.items[key] = value
+            while len(self.items) > self.size:
+                self.items.popitem(False)
+                self.evictions += 1
+        finally:
+            self.lock.release()
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.items.clear()
+        finally:
+            self.lock.release()
+
+    def __contains__(self, key):
+        return key in self.items
+
+    def __len__(self):
+        return len(self.items)
+
+    def __repr__(self):
+        return '<LRU \'%d/%d hits %d misses %d evictions %d\'>' % \
+                (len(self.items), self.size, self.hits, self.misses, self.evictions)
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -7,120 +7,395 @@ This file is licensed under the terms of the GNU General Public License
 version 2. This program is licensed "as is" without any warranty of any
 kind, whether express or implied.
 
-lzjb for Python
+lzjb for Python, and the decompressors of all the on-disk compressions
 
 """
 
+import zlib
 from util import *
+try:
+    import lz4.block as lz4_block
+except ImportError:
+    lz4_block = None
+
+MATCH_BITS = 6
+MATCH_MIN = 3
+MATCH_MAX = (1 << MATCH_BITS) + (MATCH_MIN - 1)
+OFFSET_MASK = (1 << (16 - MATCH_BITS)) - 1
+LEMPEL_SIZE = 1024
+ITEM_BITS = (1, 2, 4, 8, 16, 32, 64, 128)
 
-max_offset = 1023
-max_matched_len = 66
-
-def find_match(data, start, str):
-    if start >= str:
-        return (None, None)
-    str_len = len(data) - str
-    if str_len < 3: # we must ensure we have at least 3 char to match
-        return (None, None)
-    # see if we can find the next 3 chars from start, we do not care about  multi ocurrences
-    p = data[start:str].find(data[str:str+3])
-    if p < 0:
-        return (None, None)
-    p = p + start # offset in data
-    matched_len = 0
-    # find the longest common beginning 
-    while matched_len < str_len:
-        if data[p + matched_len] != data[str + matched_len]:
-            break
-        else:
-            matched_len = matched_len + 1
-    if matched_len > max_matched_len:
-        matched_len = max_matched_len
-    return (str - p, matched_len)
-        
 
-def lzjb_compress(data):
+def lzjb_compress(data, d_len = None):
     """
     for each map, there are 8 items, a item is:
         a match:
-                look backward max_offset at most
-                match length greater than 3, and less than max_offset
-        else just a literal item  
+                look backward OFFSET_MASK at most
+                match length at least MATCH_MIN, and at most MATCH_MAX
+        else just a literal item
 
+    This is the kernel lzjb_compress, the output is byte identical. Matches are
+    found by a hash table of LEMPEL_SIZE slots, keyed on the next 3 bytes, which
+    holds the last position those 3 bytes were seen. Only that one candidate is
+    tried for every position.
+
+    If d_len is given and the encoded data would not be shorter than d_len, give
+    up and return None, just like the kernel gives up when it can't save
+    anything.
     """
-    encoded_data = ''
-    l = len(data)
+    src = bytearray(data)
+    s_len = len(src)
+    last = s_len - MATCH_MAX # no match is tried after this position
+    if d_len is None:
+        d_limit = s_len * 2 + 2 * 8 + 1 # never reached
+    else:
+        d_limit = d_len - 1 - 2 * 8
+    dst = bytearray()
+    append = dst.append # it's called for every item
+    lempel = [0] * LEMPEL_SIZE
+    copymask = 1 << 7
+    copymap = 0
     i = 0
-    while i < l:
-        map = 0 
-        cache = ''
-
-        for n in range(8):
-            search_start = i - max_offset
-            if search_start < 0:
-                search_start = 0
-            offset, matched_len = find_match(data, search_start, i)
-            if matched_len: # match
-                cache = cache + chr(((matched_len - 3) << 2) | (offset >> 8)) + chr(get_bits(offset, 0, 8))
-                i = i + matched_len
-                map = set_bit(map, n)
-            else: # literal
-                cache = cache + data[i]
-                i = i +1
-            # there are less than 8 items
-            if i >= l:
-                encoded_data = encoded_data + chr(map) + cache
-                return encoded_data
-        # save the control byte map and 8 items cache
-        encoded_data = encoded_data + chr(map) + cache
-    
-    return encoded_data
-
-
-def copy_matched(data, offset, matched_len):
-    tmp = data[offset:]
-    for i in range(matched_len):
-        tmp += tmp[i]
-    return data[:offset] + tmp
-
-
-def lzjb_decompress(encoded_data):
-    """
-    We dont care about the decode data length, we treat the encoded_data as all useful
-    and decode them all. Please feed us well format data, and cut the decoded data
-    to the length you like.
-
-    If wrong format found,  return None
-    """
-    data = ''
-    l = len(encoded_data)
+    while i < s_len:
+        copymask <<= 1
+        if copymask == 1 << 8:
+            if len(dst) >= d_limit:
+                return None
+            copymask = 1
+            copymap = len(dst)
+            append(0)
+        if i > last:
+            append(src[i])
+            i += 1
+            continue
+        hash = (src[i] << 16) + (src[i + 1] << 8) + src[i + 2]
+        hash += hash >> 9
+        hash = (hash + (hash >> 5)) & (LEMPEL_SIZE - 1)
+        # the kernel keeps the low 16 bits of a pointer, the distance modulo
+        # OFFSET_MASK + 1 is the same as long as the source is 1K aligned
+        offset = (i - lempel[hash]) & OFFSET_MASK
+        lempel[hash] = i
+        cpy = i - offset
+        if cpy >= 0 and offset and src[i] == src[cpy] and \
+                src[i + 1] == src[cpy + 1] and src[i + 2] == src[cpy + 2]:
+            dst[copymap] |= copymask
+            if src[i : i + MATCH_MAX] == src[cpy : cpy + MATCH_MAX]:
+                mlen = MATCH_MAX
+            else:
+                mlen = MATCH_MIN
+                while src[i + mlen] == src[cpy + mlen]:
+                    mlen += 1
+            append(((mlen - MATCH_MIN) << (8 - MATCH_BITS)) | (offset >> 8))
+            append(offset & 0xff)
+            i += mlen
+        else:
+            append(src[i])
+            i += 1
+    return str(dst)
+
+
+def lzjb_decompress(encoded_data, lsize = None):
+    """
+    Decode encoded_data into a buffer of lsize bytes, decoding stops as soon as
+    the buffer is full. Copy items are done by slice assignment, so the cost is
+    linear in the decoded length.
+
+    If lsize is None, we treat the encoded_data as all useful and decode them all,
+    cut the decoded data to the length you like.
+
+    If wrong format found, return None: a copy item cut in half, a copy item
+    pointing before the beginning of data, or encoded_data used up before lsize
+    bytes are decoded.
+    """
+    src = bytearray(encoded_data)
+    l = len(src)
+    if lsize is None:
+        out = bytearray()
+        end = None
+    else:
+        out = bytearray(lsize)
+        end = lsize
     i = 0
-    while i < l:
+    d = 0 # next position in out
+    while i < l and d != end:
         # 8 bits repsent 8 item,  the two bytes of copy item is only ONE item, carefull!
-        map = ord(encoded_data[i]) # get map
+        map = src[i]
         i = i + 1
-        for n in range(8):
-            if get_bits(map, n, 1) == 0:
+        if map == 0 and i + 8 <= l and (end is None or d + 8 <= end):
+            # 8 literals, copy them at one time
+            out[d : d + 8] = src[i : i + 8]
+            i = i + 8
+            d = d + 8
+            continue
+        for bit in ITEM_BITS:
+            if d == end:
+                break
+            if not map & bit:
                 if i >= l:
-                    #print 'possible corrupt data, not enough item found n=', n
-                    return data
-                data = data + encoded_data[i] # origial data
+                    break # not enough items
+                out[d : d + 1] = src[i : i + 1] # origial data
                 i = i + 1
+                d = d + 1
+                continue
+            if i + 1 >= l:
+                return None # it's surpposed that still 2 bytes left, must be corrupt
+            # this is a copy item here
+            matched_len = (src[i] >> 2) + 3 # high 6 bits
+            # low 2 bits of the first byte and the second byte, offset relative to current position
+            offset_curr = ((src[i] & 3) << 8) | src[i + 1]
+            i = i + 2
+            offset = d - offset_curr
+            if offset_curr == 0 or offset < 0:
+                return None
+            if end is not None and matched_len > end - d:
+                matched_len = end - d
+            if offset_curr >= matched_len:
+                out[d : d + matched_len] = out[offset : offset + matched_len]
             else:
-                if i + 1 >= l:
-                    return None #it's surpposed that still 2 bytes left, must be corrupt 
-                # this is a copy item here
-                matched_len = get_bits(ord(encoded_data[i]), 2, 6) + 3 # high 6 bits
-                # low 2 bits of the first byte and the second byte, offset relative to current position
-                offset_curr = (get_bits(ord(encoded_data[i]), 0, 2) << 8) + ord(encoded_data[i+1])
-                i = i + 2
-                offset = len(data) - offset_curr
-                if offset < 0 or offset >= len(data):
-                    return None
-                data = copy_matched(data, offset, matched_len)
+                # source and destination overlap, the last offset_curr bytes repeat
+                pattern = out[offset : d]
+                out[d : d + matched_len] = (pattern * (matched_len / offset_curr + 1))[:matched_len]
+            d = d + matched_len
+    if end is not None and d != end:
+        return None
+    return str(out)
+
+def gzip_decompress(encoded_data, lsize):
+    """
+    gzip-1 to gzip-9, they are all zlib streams
+
+    Examples:
+        >>> gzip_decompress(zlib.compress('yadda ' * 4), 24)
+        'yadda yadda yadda yadda '
+        >>> gzip_decompress(zlib.compress('yadda ' * 4), 25) is None
+        True
+        >>> gzip_decompress(zlib.compress('yadda ' * 4)[:8], 24) is None
+        True
+        >>> gzip_decompress('not zlib', 8) is None
+        True
+    """
+    try:
+        data = zlib.decompressobj().decompress(encoded_data, lsize)
+    except zlib.error:
+        return None
+    if len(data) != lsize:
+        return None
     return data
 
+
+def zle_decompress(encoded_data, lsize, n = 64):
+    """
+    zero length encoding, a length byte l followed by l + 1 literals if l + 1 <= n,
+    otherwise l + 1 - n zeros
+
+    Examples:
+        >>> zle_decompress('\\x02abc\\x42\\x00d', 7)
+        'abc\\x00\\x00\\x00d'
+        >>> zle_decompress('\\xff', 192)  == '\\x00' * 192
+        True
+        >>> zle_decompress('\\x05ab', 6) is None
+        True
+        >>> zle_decompress('\\x02abc\\x42', 8) is None
+        True
+    """
+    src = bytearray(encoded_data)
+    l = len(src)
+    out = bytearray(lsize) # zeros are already there
+    i = 0
+    d = 0
+    while i < l and d < lsize:
+        run = src[i] + 1
+        i = i + 1
+        if run <= n:
+            if i + run > l or d + run > lsize:
+                return None
+            out[d : d + run] = src[i : i + run]
+            i = i + run
+        else:
+            run = run - n
+            if d + run > lsize:
+                return None
+        d = d + run
+    if d != lsize:
+        return None
+    return str(out)
+
+
+def lz4_decompress(encoded_data, lsize):
+    """
+    ZFS prefixes the lz4 block with its length, a 32 bits big endian integer.
+    The lz4 module does the work if it's installed, otherwise we decode the
+    block ourself.
+
+    Examples:
+        >>> lz4_decompress('\\x00\\x00\\x00\\x05\\x22ab\\x02\\x00', 8)
+        'abababab'
+        >>> lz4_decompress('\\x00\\x00\\x00\\x06\\x22ab\\x02\\x00', 8) is None
+        True
+        >>> lz4_decompress('\\x00\\x00', 8) is None
+        True
+    """
+    src = bytearray(encoded_data)
+    if len(src) < 4:
+        return None
+    size = (src[0] << 24) | (src[1] << 16) | (src[2] << 8) | src[3]
+    if size + 4 > len(src):
+        return None
+    if lz4_block:
+        try:
+            data = lz4_block.decompress(str(src[4 : 4 + size]), uncompressed_size = lsize)
+        except Exception:
+            return None
+        if len(data) != lsize:
+            return None
+        return data
+    return lz4_block_decompress(src, 4, 4 + size, lsize)
+
+
+def lz4_block_decompress(src, i, end, lsize):
+    """
+    Decode a lz4 block src[i:end] into lsize bytes, a sequence is:
+        token       literal length high 4 bits, match length - 4 low 4 bits,
+                    15 means more length bytes follow, until a byte isn't 255
+        literals
+        offset      16 bits little endian, the last sequence has none
+
+    A match may overlap the bytes it produces, offset 2 and length 6 repeat
+    the last 2 bytes three times.
+
+    Examples:
+        >>> def decode(s, lsize):
+        ...     return lz4_block_decompress(bytearray(s), 0, len(s), lsize)
+        >>> decode('\\x22ab\\x02\\x00', 8)
+        'abababab'
+        >>> decode('\\x50hello', 5)
+        'hello'
+
+    Lengths of 15 and more go on in the bytes after the token, 15 + 255 + 5
+    literals and 15 + 255 + 0 + 4 matched bytes:
+        >>> s = '\\xff\\xff\\x05' + 'x' * 275 + '\\x01\\x00\\xff\\x00'
+        >>> decode(s, 549) == 'x' * 549
+        True
+
+    Truncated or malformed blocks give None:
+        >>> decode(s[:-1], 549) is None
+        True
+        >>> decode(s[:100], 549) is None
+        True
+        >>> decode('\\x14a\\x05\\x00', 6) is None # offset before the start
+        True
+        >>> decode('\\x14a\\x00\\x00', 6) is None # offset 0
+        True
+        >>> decode('\\x22ab\\x02', 8) is None # offset cut in half
+        True
+        >>> decode('\\x22ab\\x02\\x00', 7) is None # more than lsize
+        True
+    """
+    out = bytearray(lsize)
+    d = 0
+    while i < end:
+        token = src[i]
+        i = i + 1
+        run = token >> 4
+        if run == 15:
+            while i < end:
+                b = src[i]
+                i = i + 1
+                run = run + b
+                if b != 255:
+                    break
+            else:
+                return None # the length bytes are cut off
+        if i + run > end or d + run > lsize:
+            return None
+        out[d : d + run] = src[i : i + run]
+        i = i + run
+        d = d + run
+        if i >= end:
+            break # the last sequence, literals only
+        if i + 2 > end:
+            return None
+        offset = src[i] | (src[i + 1] << 8)
+        i = i + 2
+        matched_len = token & 15
+        if matched_len == 15:
+            while i < end:
+                b = src[i]
+                i = i + 1
+                matched_len = matched_len + b
+                if b != 255:
+                    break
+            else:
+                return None # the length bytes are cut off
+        matched_len = matched_len + 4
+        start = d - offset
+        if offset == 0 or start < 0 or d + matched_len > lsize:
+            return None
+        if offset >= matched_len:
+            out[d : d + matched_len] = out[start : start + matched_len]
+        else:
+            pattern = out[start : d]
+            out[d : d + matched_len] = (pattern * (matched_len / offset + 1))[:matched_len]
+        d = d + matched_len
+    if d != lsize:
+        return None
+    return str(out)
+
+
+def empty_decompress(encoded_data, lsize):
+    return '\x00' * lsize
+
+
+# zio_compress, the on-disk compression enum, index is the value in blkptr
+ZIO_COMPRESS = []
+
+# codec registry, compression name: decompress(encoded_data, lsize), which returns
+# lsize bytes, or None if the data is corrupted
+CODECS = {}
+
+def register_codec(value, name, decompress):
+    """
+    Register the decompress function of the compression whose on-disk value is value
+    """
+    while len(ZIO_COMPRESS) <= value:
+        ZIO_COMPRESS.append('unknown')
+    ZIO_COMPRESS[value] = name
+    CODECS[name] = decompress
+
+register_codec(0, 'unknown', None)
+register_codec(1, 'on', lzjb_decompress) # lzjb is the default
+register_codec(2, 'off', None)
+register_codec(3, 'lzjb', lzjb_decompress)
+register_codec(4, 'empty', empty_decompress)
+for level in range(1, 10):
+    register_codec(4 + level, 'gzip-%d' % level, gzip_decompress)
+register_codec(14, 'zle', zle_decompress)
+register_codec(15, 'lz4', lz4_decompress)
+
+
+def decompress(comp, encoded_data, lsize):
+    """
+    Decompress a block
+
+        @comp       compression name, see ZIO_COMPRESS
+        @lsize      logical size of the block
+
+    Returns
+        lsize bytes, encoded_data itself if it's not compressed. None if it's
+        corrupted or compressed by something we don't know.
+    """
+    if comp == 'off' or comp == 'unknown':
+        return encoded_data
+    codec = CODECS.get(comp)
+    if codec is None:
+        print 'compression %s not supported' % comp
+        return None
+    return codec(encoded_data, lsize)
+
+
 if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
     E = '\x40yadda \x20\x06,\x20+blah\x1c\x05'
     M = 'yadda yadda yadda,+blah+blah+blah'
     print 'E:'
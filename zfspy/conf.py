@@ -6,3 +6,37 @@ else:
     ZPOOL_CACHE = '/etc/zfs/zpool.cache'
 
 debug = False
+
+# seconds before an unused vdev handle is closed
+vdev_idle_timeout = 60
+
+# map file and block vdevs into memory, uncompressed blocks are then returned
+# as buffers of the mapping instead of copies
+use_mmap = False
+
+# bytes of decompressed blocks ZIO keeps in its ARC
+arc_size = 64 << 20
+
+# ZIO.read_blks merges blocks less than read_gap bytes apart, into reads of
+# read_max bytes at most
+read_gap = 32 << 10
+read_max = 1 << 20
+
+# blocks a ZFile read keeps in flight
+queue_depth = 16
+
+# blocks a ZFile keeps for reads smaller than a block
+file_buffer_blocks = 8
+
+# parsed dnodes each OBJSet keeps
+dnode_cache_size = 4096
+
+# names ZFS.lookup keeps resolved, not found ones too
+dentry_cache_size = 65536
+
+# directories ZFS.walk expands at the same time
+walk_workers = 8
+
+# ranges of files copy_tree copies at the same time, and their size
+copy_workers = 8
+copy_range = 64 << 20
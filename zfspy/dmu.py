@@ -7,11 +7,14 @@ This file is licensed under the terms of the GNU General Public License
 version 2. This program is licensed "as is" without any warranty of any
 kind, whether express or implied.
 """
-from oodict import OODict
+from oodict import OODict, Record
+import conf
 from util import *
 from nvpair import NVPair, StreamUnpacker
 from spa import SPA, BlockPtr
 from zio import ZIO
+from cache import LRU
+from layout import DNODE_PHYS, OBJSET_TYPE
 
 DNODE_CORE_SIZE = 64
 DNODE_SIZE = 512
@@ -70,7 +73,8 @@ DMU_OBJSET_TYPE = [
 ]
 
 
-class DNode(OODict):
+class DNode(Record('DNode', 'vdev type indblkshift nlevels nblkptr bonustype checksum compress '
+                           'datablkszsec bonuslen maxblkid secphys blkptr bonus')):
     """
     Objects are Dnodes
 
@@ -94,27 +98,28 @@ class DNode(OODict):
 
     """
 
-    def __init__(self, vdev, data):
+    __slots__ = ()
+
+    def __new__(cls, vdev, data, offset = 0):
+        """
+        Parse the dnode at offset of data, data is normally a whole block of dnodes
+        """
         if not data:
-            return
-        self.vdev = vdev
-        su = StreamUnpacker(data)
-        self.type, self.indblkshift, self.nlevels, self.nblkptr, self.bonustype, \
-                   self.checksum, self.compress, pad = su.repeat('uint8', 8)
-        self.type = DMU_OBJTYPE[self.type]
-        self.datablkszsec, self.bonuslen = su.repeat('uint16', 2)
-        su.rewind(-4)
-        self.maxblkid, self.secphys, pad = su.repeat('uint64', 3)
-        bonus_offset = DNODE_CORE_SIZE + BlockPtr_SIZE * self.nblkptr
-        self.blkptr = []
-        for blk in split_records(data[DNODE_CORE_SIZE : bonus_offset], BlockPtr_SIZE):
-            bp = BlockPtr(blk)
-            if not bp.is_hole():
-                self.blkptr.append(bp)
-        self.bonus = data[bonus_offset : bonus_offset + self.bonuslen]
+            return None
+        core = DNODE_PHYS.unpack_from(data, offset)
+        type, nblkptr, bonuslen = core[0], core[3], core[8]
+        if type < len(DMU_OBJTYPE):
+            type = DMU_OBJTYPE[type]
+        else:
+            type = 'unknown %d' % type # newer object types
+        # holes are kept, the index of a blkptr tells which blocks are under it
+        blkptr = tuple([BlockPtr(data, offset + DNODE_CORE_SIZE + BlockPtr_SIZE * i) for i in range(nblkptr)])
+        bonus_offset = DNODE_CORE_SIZE + BlockPtr_SIZE * nblkptr
+        bonus = view(data, offset + bonus_offset, bonuslen)
 
         debug('dnode type=%s nlevels=%s nblkptr=%s bonustype=%s maxblkid=%s' %  \
-                (self.type, self.nlevels, self.nblkptr, self.bonustype, self.maxblkid))
+                (type, core[2], nblkptr, core[4], core[9]))
+        return tuple.__new__(cls, (vdev, type) + core[1:] + (blkptr, bonus))
 
     def get_blk(self, id):
         """
@@ -123,37 +128,128 @@ class DNode(OODict):
         indirect block onlys contain block pointers, its size is 1 << indblkshift. maxblkid is the max id
         of level 0 blocks
         """
+        for blkid, data in self.iter_blocks(id, id + 1, True):
+            return data
+        return None
+
+    def iter_blocks(self, start = 0, end = None, data = False):
+        """
+        Walk the block pointer tree depth first, from the top level blkptr down to
+        level 0, every indirect block on the way is read only once. Holes, and
+        whole subtrees of them, are skipped without reading anything, a block
+        pointer with birth txg 0 or fill count 0 has no data under it.
+
+            @start, end     level 0 block ids, walk [start, end), end default to
+                            maxblkid + 1
+            @data           yield block data instead of block pointers, level 0
+                            blocks under one indirect block are fetched together
+                            by ZIO.read_blks, conf.read_max bytes at a time
+
+        Yields
+            (blkid, BlockPtr), or (blkid, data) if data is True, in blkid order,
+            data is None if the level 0 block can't be read
+
+        Raises
+            IOError if an indirect block can't be read
+        """
+        if end is None or end > self.maxblkid + 1:
+            end = self.maxblkid + 1
+        if start >= end or not self.nlevels:
+            return iter([]) # a free dnode has no levels
         bp_per_indirectblk = (1 << self.indblkshift) / BlockPtr_SIZE
-        if id > self.maxblkid:
-            return None
-        
-        debug('bp_per_indirectblk=%d, nlevels %d' %(bp_per_indirectblk, self.nlevels))
-
-        # compute offset of every level from bottom to top
-        map = []
-        blkid = id
-        for level in range(0, self.nlevels-1):
-            blkid, offset = blkid / bp_per_indirectblk, blkid % bp_per_indirectblk
-            map.append((blkid, offset))
-        debug('levels offset for blkid %d: %s' % (id, map))
-        toplevel_blkid = blkid
-        # top level only can have 3 blocks at most, its blkid must be less than 
-        # the number of real blkptr we have. if it's greater than 3, it means that
-        # we should have one more level then.
-        if toplevel_blkid >= len(self.blkptr):
-            return None
-        bp = self.blkptr[toplevel_blkid]
-        blk_data = ZIO.read_blk(self.vdev, bp)
-        levels = range(self.nlevels - 1)
-        levels.reverse()
-        for level in levels: 
-            # offset in blk really matters, blkid in level doesn't
-            offset = map[level][1]
-            debug('offset %d in level %d' % (offset, level))
-            bp = BlockPtr(get_record(blk_data, BlockPtr_SIZE, offset))
+        span = bp_per_indirectblk ** (self.nlevels - 1) # level 0 blocks under a top level blkptr
+        top = [(i * span, bp) for i, bp in enumerate(self.blkptr)]
+        return self._walk(top, self.nlevels - 1, bp_per_indirectblk, start, end, data)
+
+    def _walk(self, bps, level, bp_per_indirectblk, start, end, data):
+        """
+        bps are [(first level 0 blkid under it, bp)] of level
+        """
+        span = bp_per_indirectblk ** level
+        bps = [(first, bp) for first, bp in bps
+                if first < end and first + span > start and not (bp.is_hole() or bp.fill_count == 0)]
+        if level == 0:
+            if data:
+                # hold no more than read_max bytes of blocks at a time
+                i = 0
+                while i < len(bps):
+                    j = i + 1
+                    size = bps[i][1].lsize
+                    while j < len(bps) and size + bps[j][1].lsize <= conf.read_max:
+                        size += bps[j][1].lsize
+                        j = j + 1
+                    batch = bps[i:j]
+                    for (blkid, bp), blk_data in zip(batch, ZIO.read_blks(self.vdev, [bp for first, bp in batch])):
+                        yield blkid, blk_data
+                    i = j
+            else:
+                for item in bps:
+                    yield item
+            return
+
+        child_span = span / bp_per_indirectblk
+        for first, bp in bps:
+            blk_data = ZIO.read_blk(self.vdev, bp)
+            if blk_data is None:
+                # lost data must not look like a hole
+                raise IOError('level %d block at blkid %d can\'t be read' % (level, first))
+            # only parse the children in [start, end)
+            lo = max(0, (start - first) / child_span)
+            hi = min(bp_per_indirectblk, (end - first + child_span - 1) / child_span)
+            debug('level %d blk at %d, children %d-%d' % (level, first, lo, hi))
+            children = [(first + i * child_span, BlockPtr(blk_data, i * BlockPtr_SIZE)) for i in range(lo, hi)]
+            for item in self._walk(children, level - 1, bp_per_indirectblk, start, end, data):
+                yield item
+
+    def next_hole(self, start = 0):
+        """
+        Find the first hole at or after level 0 block start, blocks past maxblkid
+        are all holes.
+
+        Subtrees of holes stop the search without being read, so do full ones,
+        whose fill count equals the blocks under them, level 0 blocks have a fill
+        count of 1. Blocks of dnodes count their dnodes instead, full subtrees of
+        DMU_OT_DNODE have to be walked.
+
+        Returns
+            block id
+
+        Raises
+            IOError if an indirect block on the way can't be read
+        """
+        end = self.maxblkid + 1
+        if start >= end or not self.nlevels:
+            return start
+        bp_per_indirectblk = (1 << self.indblkshift) / BlockPtr_SIZE
+        span = bp_per_indirectblk ** (self.nlevels - 1)
+        top = [(i * span, bp) for i, bp in enumerate(self.blkptr)]
+        hole = self._next_hole(top, self.nlevels - 1, bp_per_indirectblk, start)
+        if hole is None or hole > end:
+            return end
+        return hole
+
+    def _next_hole(self, bps, level, bp_per_indirectblk, start):
+        span = bp_per_indirectblk ** level
+        counts_blocks = self.type != 'DMU_OT_DNODE'
+        for first, bp in bps:
+            if first + span <= start:
+                continue
+            if bp.is_hole() or bp.fill_count == 0:
+                return max(first, start)
+            if level == 0 or (counts_blocks and bp.fill_count >= span):
+                continue
             blk_data = ZIO.read_blk(self.vdev, bp)
-        return blk_data
- 
+            if blk_data is None:
+                raise IOError('level %d block at blkid %d can\'t be read' % (level, first))
+            child_span = span / bp_per_indirectblk
+            lo = max(0, (start - first) / child_span)
+            children = [(first + i * child_span, BlockPtr(blk_data, i * BlockPtr_SIZE)) for i in range(lo, bp_per_indirectblk)]
+            hole = self._next_hole(children, level - 1, bp_per_indirectblk, start)
+            if hole is not None:
+                return hole
+        return None
+
+
 class OBJSet(object):
     """
     1k
@@ -165,7 +261,7 @@ class OBJSet(object):
     """
     def __init__(self, vdev, data):
         self.vdev = vdev
-        self.meta_dnode = DNode(self.vdev, data[0:DNODE_SIZE])
+        self.meta_dnode = DNode(self.vdev, data)
         
         if self.meta_dnode.type != 'DMU_OT_DNODE':
             print 'currupted objset'
@@ -173,7 +269,8 @@ class OBJSet(object):
 
         zil_header_end = DNODE_SIZE + ZIL_HEADER_SIZE
         self.zil_header = data[DNODE_SIZE: zil_header_end]
-        self.os_type = DMU_OBJSET_TYPE[StreamUnpacker(data[zil_header_end: zil_header_end + 8]).uint64()]
+        self.os_type = DMU_OBJSET_TYPE[OBJSET_TYPE.unpack_from(data, zil_header_end)[0]]
+        self.dnodes = LRU(conf.dnode_cache_size) # object id -> DNode
 
     def get_object(self, index):
         """
@@ -185,7 +282,14 @@ class OBJSet(object):
 
         maxblkid is the max id of level 0 blocks, so the max object number in this dnode is
             (datablkszsec << 9) / DNODE_SIZE * maxblkid
+
+        Parsed dnodes are cached by object id. On a miss all the dnodes of the
+        level 0 block are parsed and cached together, neighbours are usually
+        wanted soon after.
         """
+        dnode = self.dnodes.get(index)
+        if dnode is not None:
+            return dnode
         md = self.meta_dnode
         object_per_level0blk = (md.datablkszsec << 9) / DNODE_SIZE
         blkid = index / object_per_level0blk
@@ -196,8 +300,44 @@ class OBJSet(object):
         if not blk_data:
             debug('object index %d out of range' % index)
             return None
-        return DNode(md.vdev, get_record(blk_data, DNODE_SIZE, level0blk_offset))
+        first = index - level0blk_offset
+        for i in range(len(blk_data) / DNODE_SIZE):
+            sibling = DNode(md.vdev, blk_data, i * DNODE_SIZE)
+            self.dnodes.put(first + i, sibling)
+            if i == level0blk_offset:
+                dnode = sibling
+        return dnode
+
+    def iter_objects(self, types = None, start = 0):
+        """
+        Walk the meta dnode once and yield all the allocated objects. Block
+        pointers with fill count 0 have no allocated dnodes under them, these
+        regions are skipped without being read. Free dnodes in a block are
+        skipped by their type byte, before they are parsed.
 
+            @types  names of DMU_OBJTYPE to yield, default to all
+            @start  first object id
+
+        Yields
+            (object id, DNode)
+
+        Raises
+            IOError if a block of dnodes can't be read
+        """
+        md = self.meta_dnode
+        object_per_level0blk = (md.datablkszsec << 9) / DNODE_SIZE
+        if types is not None:
+            types = set([DMU_OBJTYPE.index(t) for t in types])
+        for blkid, blk_data in md.iter_blocks(start / object_per_level0blk, data = True):
+            if blk_data is None:
+                # lost dnodes must not look like free ones
+                raise IOError('dnode block %d can\'t be read' % blkid)
+            first = blkid * object_per_level0blk
+            for i in range(max(0, start - first), len(blk_data) / DNODE_SIZE):
+                type = ord(blk_data[i * DNODE_SIZE])
+                if type == 0 or (types is not None and type not in types):
+                    continue
+                yield first + i, DNode(md.vdev, blk_data, i * DNODE_SIZE)
 
     def __repr__(self):
         return '<OBJSet \'%s\'>' % self.os_type 
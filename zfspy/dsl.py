@@ -14,6 +14,7 @@ from spa import BlockPtr
 from dmu import OBJSet
 from zap import *
 from zio import *
+from layout import DSL_DIR_PHYS, DSL_DATASET_PHYS
 from zpl import *
 
 class DSL_DataSet(OODict):
@@ -25,12 +26,11 @@ class DSL_DataSet(OODict):
         self.objset = objset
         self.dnode = objset.get_object(obj_index)
         data = self.dnode.bonus
-        f = StreamUnpacker(data)
         self.ds_dir_obj, self.ds_prev_snap_obj, self.ds_prev_snap_txg, self.ds_next_snap_obj, \
         self.ds_snapnames_zapobj, self.ds_num_children, self.ds_creation_time, self.ds_creation_txg, \
         self.ds_deadlist_obj, self.ds_used_bytes, self.ds_compressed_bytes, self.ds_uncompressed_bytes, \
-        self.ds_unique_bytes, self.ds_fsid_guid, self.ds_guid, self.ds_flags = f.repeat('uint64', 16)
-        self.ds_bp = BlockPtr(data[128:])
+        self.ds_unique_bytes, self.ds_fsid_guid, self.ds_guid, self.ds_flags = DSL_DATASET_PHYS.unpack_from(data)
+        self.ds_bp = BlockPtr(data, 128)
 
         self._load()
 
@@ -74,11 +74,10 @@ class DSL_Dir(OODict):
 
         # dsl_dir and dsl_dataset are in the bonus buffer of a dnode
         data = self.dnode.bonus
-        f = StreamUnpacker(data)
-    	self.dd_creation_time, self.dd_head_dataset_obj, self.dd_parent_obj, \
+        self.dd_creation_time, self.dd_head_dataset_obj, self.dd_parent_obj, \
         self.dd_origin_obj, self.dd_child_dir_zapobj, \
         self.dd_used_bytes, self.dd_compressed_bytes, self.dd_uncompressed_bytes, \
-        self.dd_quota, self.dd_reserved, self.dd_props_zapobj, self.dd_deleg_zapobj = f.repeat('uint64', 12)
+        self.dd_quota, self.dd_reserved, self.dd_props_zapobj, self.dd_deleg_zapobj = DSL_DIR_PHYS.unpack_from(data)
 
         self._load()
 
@@ -87,7 +86,6 @@ class DSL_Dir(OODict):
         Load Dir info
         """
         self.head_dataset = DSL_DataSet(self.objset, self.dd_head_dataset_obj)
-        # we are not sure that it's a mzap here
         self.child_dir = ZAP.from_dnode(self.objset, self.dd_child_dir_zapobj)
         self.props = ZAP.from_dnode(self.objset, self.dd_props_zapobj)
     
@@ -110,10 +108,10 @@ class DSL_Dir(OODict):
             return ds # we are root
         for level in levels:
             parent = ds
-            if level not in parent.child_dir.entries:
+            id = parent.child_dir.lookup(level)
+            if id is None:
                 return None # can't find this name
 
-            id = parent.child_dir.entries[level]
             debug('name: %s id=%s' % (level, id))
             # Fixme, do all the child obj sets always have the same objset as parent?
             ds = DSL_Dir(parent.objset, id) # we assume the object is a dsl dir 
@@ -0,0 +1,122 @@
+"""
+ZFSpy: Python bindings for ZFS
+
+Copyright (C) 2008 Chen Zheng <nkchenz@gmail.com>
+
+This file is licensed under the terms of the GNU General Public License
+version 2. This program is licensed "as is" without any warranty of any
+kind, whether express or implied.
+"""
+import sys
+import threading
+from Queue import Queue
+from collections import deque
+
+
+class Future(object):
+    """
+    Result of a job running in a ReadEngine
+    """
+
+    def __init__(self, func, args):
+        self.func = func
+        self.args = args
+        self.done = threading.Event()
+        self.value = None
+        self.exc_info = None
+
+    def run(self):
+        try:
+            self.value = self.func(*self.args)
+        except:
+            self.exc_info = sys.exc_info()
+        self.done.set()
+
+    def result(self):
+        """
+        Wait for the job, return its value or raise its exception
+        """
+        self.done.wait()
+        if self.exc_info:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self.value
+
+
+class ReadEngine(object):
+    """
+    ReadEngine
+        a thread pool which keeps many block reads and decompressions in flight
+
+    Threads are started on demand, as many as the largest queue depth ever
+    asked for. They are daemons, nobody has to stop them.
+
+    Examples:
+        >>> e = ReadEngine()
+        >>> list(e.map(lambda x: x * 2, range(5), 3))
+        [0, 2, 4, 6, 8]
+    """
+
+    def __init__(self):
+        self.jobs = Queue()
+        self.workers = 0
+        self.lock = threading.Lock()
+
+    def grow(self, n):
+        """
+        Start threads until there are n of them
+        """
+        self.lock.acquire()
+        try:
+            while self.workers < n:
+                t = threading.Thread(target = self._work)
+                t.setDaemon(True)
+                t.start()
+                self.workers += 1
+        finally:
+            self.lock.release()
+
+    def _work(self):
+        while True:
+            self.jobs.get().run()
+
+    def submit(self, func, *args):
+        """
+        Run func(*args) in the pool
+
+        Returns
+            Future
+        """
+        if not self.workers:
+            self.grow(1)
+        f = Future(func, args)
+        self.jobs.put(f)
+        return f
+
+    def map(self, func, items, depth):
+        """
+        Yield func(item) for every item, in order, while up to depth of them
+        are running. Only depth results are held at any time, so memory is
+        bounded however many items there are.
+        """
+        depth = max(depth, 1)
+        self.grow(depth)
+        pending = deque()
+        for item in items:
+            pending.append(self.submit(func, item))
+            if len(pending) >= depth:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+# shared by all the readers
+engine = ReadEngine()
+
+# expands directories for ZFS.walk, its jobs wait on reads of engine, so they
+# can't run in engine itself
+walker = ReadEngine()
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -2,6 +2,7 @@
 from zfspy import *
 
 from pprint import pprint
+import shutil
 
 #conf.debug = True
 
@@ -66,8 +67,9 @@ f = fs.open('linux-2.6.18-53.1.19.el5.tar.bz2')
 print f.dnode
 print f.znode.size
 
+# ZFile is file like, copy it block by block
 tmp = open('linux-2.6.18-53.1.19.el5.tar.bz2', 'w+')
-tmp.write(f.read())
+shutil.copyfileobj(f, tmp, f.blk_size)
 
 """
 fs.diff(snapa, snapb)
@@ -0,0 +1,174 @@
+"""
+ZFSpy: Python bindings for ZFS
+
+Copyright (C) 2008 Chen Zheng <nkchenz@gmail.com>
+
+This file is licensed under the terms of the GNU General Public License
+version 2. This program is licensed "as is" without any warranty of any
+kind, whether express or implied.
+
+Export a tree of a ZPL filesystem as a POSIX tar stream, run as
+    python -m zfspy.export pool/dataset [path] [file.tar] > tree.tar
+"""
+import os
+import sys
+import time
+import tarfile
+from os.path import normpath, join
+from util import *
+
+TAR_TYPE = {
+'S_IFDIR': tarfile.DIRTYPE,
+'S_IFREG': tarfile.REGTYPE,
+'S_IFLNK': tarfile.SYMTYPE,
+'S_IFIFO': tarfile.FIFOTYPE,
+}
+
+
+class BlockReader(object):
+    """
+    BlockReader
+        file like reader of a ZFile fed by ZFile.blocks
+
+    The read engine fetches and decompresses the next queue_depth blocks while
+    the ones before are written, only these blocks are held in memory. read(n)
+    always returns n bytes before the end, tarfile wants that.
+    """
+
+    def __init__(self, f, queue_depth = None):
+        self.blocks = f.blocks(queue_depth)
+        self.buf = ''
+        self.pos = 0
+
+    def read(self, n):
+        data = []
+        while n > 0:
+            if self.pos >= len(self.buf):
+                self.buf = next(self.blocks, '')
+                self.pos = 0
+                if not self.buf:
+                    break
+            piece = self.buf[self.pos:self.pos + n]
+            self.pos += len(piece)
+            n -= len(piece)
+            data.append(piece)
+        return ''.join(data)
+
+
+class TarExport(object):
+    """
+    TarExport
+        write files, directories, symlinks and fifos of a ZFS to a tar stream,
+        with their mode, uid, gid and mtime
+
+    Directories are listed by ZFS.scandir, their entries are stat'ed in bulk.
+    Holes of sparse files are written as zeros, they are not read, but tarfile
+    has no GNU sparse output, so they do take space in the stream.
+    """
+
+    def __init__(self, fs, out, queue_depth = None):
+        self.fs = fs
+        self.tar = tarfile.open(fileobj = out, mode = 'w|', format = tarfile.PAX_FORMAT)
+        self.queue_depth = queue_depth
+        self.files = 0
+        self.bytes = 0
+
+    def add(self, arcname, st):
+        """
+        Add one object by its Stat, the contents of a directory are not added
+        """
+        if st.type not in TAR_TYPE:
+            debug('skip %s %s' % (arcname, st.type))
+            return
+        ti = tarfile.TarInfo(arcname)
+        ti.type = TAR_TYPE[st.type]
+        ti.mode = st.st_mode & 07777
+        ti.uid = st.st_uid
+        ti.gid = st.st_gid
+        ti.mtime = int(st.st_mtime)
+        fileobj = None
+        if ti.type == tarfile.REGTYPE:
+            ti.size = st.st_size
+            fileobj = BlockReader(self.fs.open_obj(st.st_ino), self.queue_depth)
+        elif ti.type == tarfile.SYMTYPE:
+            ti.linkname = self.fs.readlink(st.st_ino)
+        self.tar.addfile(ti, fileobj)
+        self.files += 1
+        self.bytes += ti.size
+
+    def add_tree(self, path, arcname = '.'):
+        """
+        Add path and everything under it, depth first
+
+        Returns
+            False if path is not found
+        """
+        path = normpath(join('/', path))
+        id = self.fs.lookup(path)
+        if not id:
+            print >> sys.stderr, '%s not found' % path
+            return False
+        st = self.fs.stat_many([id])[0]
+        self.add(arcname, st)
+        if st.type != 'S_IFDIR':
+            return True
+        stack = [(path, arcname)]
+        while stack:
+            dirpath, arcdir = stack.pop()
+            for name, st in self.fs.scandir(dirpath):
+                if st is None:
+                    continue
+                self.add(join(arcdir, name), st)
+                if st.type == 'S_IFDIR':
+                    stack.append((join(dirpath, name), join(arcdir, name)))
+        return True
+
+    def close(self):
+        """
+        Write the end of the archive, out is not closed
+        """
+        self.tar.close()
+
+
+def export_tar(fs, path, out, queue_depth = None):
+    """
+    Write the tree under path of fs to out, a file opened for writing
+
+    Returns
+        (objects, bytes of file data), None if path is not found
+    """
+    export = TarExport(fs, out, queue_depth)
+    found = export.add_tree(path)
+    export.close()
+    if not found:
+        return None
+    return export.files, export.bytes
+
+
+if __name__ == '__main__':
+    from zpool import ZPool
+    if len(sys.argv) < 2:
+        print >> sys.stderr, 'usage: python -m zfspy.export pool/dataset [path] [file.tar]'
+        sys.exit(1)
+    # the archive gets fd 1 to itself, whatever the library prints goes to stderr
+    archive = os.fdopen(os.dup(sys.stdout.fileno()), 'wb')
+    sys.stdout = sys.stderr
+    opened = ZPool.open_dataset(sys.argv[1])
+    if not opened:
+        sys.exit(1)
+    pool, fs = opened
+    path = '/'
+    if len(sys.argv) > 2:
+        path = sys.argv[2]
+    if len(sys.argv) > 3:
+        out = open(sys.argv[3], 'wb')
+    else:
+        out = archive
+    start = time.time()
+    result = export_tar(fs, path, out)
+    out.flush()
+    pool.close()
+    if not result:
+        sys.exit(1)
+    elapsed = max(time.time() - start, 1e-6)
+    print >> sys.stderr, '%d objects, %d bytes, %.1f MB/s' % (result[0], result[1], result[1] / elapsed / 1e6)
@@ -0,0 +1,327 @@
+"""
+ZFSpy: Python bindings for ZFS
+
+Copyright (C) 2008 Chen Zheng <nkchenz@gmail.com>
+
+This file is licensed under the terms of the GNU General Public License
+version 2. This program is licensed "as is" without any warranty of any
+kind, whether express or implied.
+
+Copy a tree of a ZPL filesystem out to the local filesystem, run as
+    python -m zfspy.extract pool/dataset path dest [workers]
+"""
+import os
+import sys
+import time
+from os.path import normpath, join, basename, exists
+from collections import deque
+from util import *
+from oodict import OODict
+from engine import ReadEngine
+import conf
+
+# copies ranges of files for copy_tree, its jobs read blocks, so it's not engine
+copier = ReadEngine()
+
+# bytes a worker reads and writes at a time
+COPY_PIECE = 1 << 20
+
+
+class Journal(object):
+    """
+    Journal
+        paths of the files already copied, one per line, appended as they are
+        done. A copy started again with the same journal skips them.
+    """
+
+    def __init__(self, path):
+        self.done = set()
+        self.f = None
+        if not path:
+            return
+        if exists(path):
+            for line in open(path):
+                self.done.add(line.rstrip('\n').decode('string_escape'))
+        self.f = open(path, 'a')
+
+    def __contains__(self, path):
+        return path in self.done
+
+    def add(self, path):
+        self.done.add(path)
+        if self.f:
+            self.f.write(path.encode('string_escape') + '\n')
+            self.f.flush()
+
+    def close(self):
+        if self.f:
+            self.f.close()
+
+
+class TreeCopy(object):
+    """
+    TreeCopy
+        copy files, directories, symlinks and fifos of a ZFS out with a pool of
+        workers, then set their mode, owner and times
+
+    Files are cut in ranges of conf.copy_range bytes, each one is a job of the
+    pool, so a huge file is copied by all the workers together. Only the data
+    regions, found by ZFile.next_data and next_hole, are read and written, the
+    files are truncated to their size first, holes stay holes. A file is
+    finished, and written to the journal, when all its ranges are done.
+    Directories are finished last, deepest first, their times would change if
+    anything was created in them after.
+
+    A file or directory which can't be read is reported on stderr and in
+    stats.errors, the copy goes on with the rest of the tree. Failed files are
+    not journaled, a copy started again tries them again.
+    """
+
+    def __init__(self, fs, workers = None, journal = None, report = 10):
+        """
+            @workers    ranges copied at the same time, default to conf.copy_workers
+            @journal    path of the journal, None for no journal
+            @report     seconds between progress reports on stderr, 0 for none
+        """
+        self.fs = fs
+        self.workers = workers or conf.copy_workers
+        self.journal = Journal(journal)
+        self.report = report
+        self.pending = deque() # (future, path, st) of ranges in flight
+        self.remain = {} # path -> ranges not done yet
+        self.failed = set() # paths of files with a failed range
+        self.dirs = [] # (path, st)
+        self.errors = [] # (path, reason)
+        self.stats = OODict({'files': 0, 'dirs': 0, 'skipped': 0, 'bytes': 0, 'failed': 0})
+        self.start = self.last_report = time.time()
+
+    def copy(self, src, dest):
+        """
+        Copy path src to dest, a directory becomes dest, a file dest/name
+
+        Returns
+            stats, None if src is not found
+        """
+        src = normpath(join('/', src))
+        try:
+            id = self.fs.lookup(src)
+            if not id:
+                print >> sys.stderr, '%s not found' % src
+                return None
+            copier.grow(self.workers)
+            st = self.fs.stat_many([id])[0]
+            if st.type == 'S_IFDIR':
+                self._copy_dir(src, dest, st)
+            else:
+                if not exists(dest):
+                    os.makedirs(dest)
+                self._copy_one(join(dest, basename(src)), st)
+            while self.pending:
+                self._wait()
+            for path, st in reversed(self.dirs):
+                self._finish(path, st)
+        finally:
+            self.journal.close()
+        return self._stats()
+
+    def _copy_dir(self, src, dest, st):
+        stack = [(src, dest, st)]
+        while stack:
+            dirpath, destdir, st = stack.pop()
+            if not exists(destdir):
+                os.makedirs(destdir)
+            else:
+                # finished by an earlier run, maybe read only, _finish sets the mode again
+                os.chmod(destdir, os.stat(destdir).st_mode & 07777 | 0700)
+            self.dirs.append((destdir, st))
+            self.stats.dirs += 1
+            try:
+                for name, st in self.fs.scandir(dirpath):
+                    if st is None:
+                        continue
+                    if st.type == 'S_IFDIR':
+                        stack.append((join(dirpath, name), join(destdir, name), st))
+                    else:
+                        self._copy_one(join(destdir, name), st)
+            except IOError, e:
+                # the entries read so far are copied, the rest of the directory is lost
+                self._fail(destdir, e)
+
+    def _copy_one(self, path, st):
+        if path in self.journal:
+            self.stats.skipped += 1
+            return
+        try:
+            if self._create(path, st):
+                self._finish(path, st)
+        except (IOError, OSError), e:
+            self._fail(path, e)
+
+    def _create(self, path, st):
+        """
+        Create path, and submit the ranges of a regular file
+
+        Returns
+            True if path is done and can be finished now
+        """
+        if os.path.lexists(path):
+            # left by an earlier run, maybe finished read only before it was journaled
+            os.unlink(path)
+        if st.type == 'S_IFLNK':
+            target = self.fs.readlink(st.st_ino)
+            if target is None:
+                raise IOError('symlink target can\'t be read')
+            os.symlink(target, path)
+        elif st.type == 'S_IFIFO':
+            os.mkfifo(path)
+        elif st.type == 'S_IFREG':
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0600)
+            os.ftruncate(fd, st.st_size)
+            os.close(fd)
+            ranges = range(0, st.st_size, conf.copy_range)
+            self.remain[path] = len(ranges)
+            for offset in ranges:
+                while len(self.pending) >= self.workers * 2:
+                    self._wait()
+                length = min(conf.copy_range, st.st_size - offset)
+                f = copier.submit(self._copy_range, st.st_ino, path, offset, length)
+                self.pending.append((f, path, st))
+            if ranges:
+                return False
+        else:
+            debug('skip %s %s' % (path, st.type))
+            return False
+        return True
+
+    def _copy_range(self, id, path, offset, length):
+        """
+        Copy the data regions in [offset, offset + length) of file id to path,
+        run by workers
+
+        Returns
+            bytes copied
+        """
+        f = self.fs.open_obj(id)
+        fd = os.open(path, os.O_WRONLY)
+        end = offset + length
+        copied = 0
+        try:
+            pos = offset
+            while pos < end:
+                data_start = f.next_data(pos)
+                if data_start is None or data_start >= end:
+                    break
+                data_end = min(f.next_hole(data_start), end)
+                os.lseek(fd, data_start, os.SEEK_SET)
+                for piece in xrange(data_start, data_end, COPY_PIECE):
+                    data = f.pread(piece, min(COPY_PIECE, data_end - piece))
+                    written = 0
+                    while written < len(data):
+                        # write(2) may write less than we give it
+                        written += os.write(fd, buffer(data, written))
+                    copied += len(data)
+                pos = data_end
+        finally:
+            os.close(fd)
+        return copied
+
+    def _wait(self):
+        # ranges are waited for in the order they are submitted
+        f, path, st = self.pending.popleft()
+        try:
+            self.stats.bytes += f.result()
+        except (IOError, OSError), e:
+            if path not in self.failed:
+                self.failed.add(path)
+                self._fail(path, e)
+        self.remain[path] -= 1
+        if not self.remain[path]:
+            del self.remain[path]
+            if path in self.failed:
+                self.failed.remove(path)
+            else:
+                self._finish(path, st)
+        if self.report and time.time() - self.last_report >= self.report:
+            self.last_report = time.time()
+            s = self._stats()
+            print >> sys.stderr, '%d files %d dirs %.0f files/s %.1f MB/s' % \
+                    (s.files, s.dirs, s.files_per_sec, s.mb_per_sec)
+
+    def _finish(self, path, st):
+        """
+        Set mode, owner and times, owners only if we are allowed to. Python 2
+        can't set the times of a symlink, they are left as they are unless
+        os.lutimes is there.
+        """
+        if st.type == 'S_IFLNK':
+            try:
+                os.lchown(path, st.st_uid, st.st_gid)
+            except OSError:
+                pass
+            if hasattr(os, 'lutimes'):
+                os.lutimes(path, (st.st_atime, st.st_mtime))
+        else:
+            try:
+                os.chown(path, st.st_uid, st.st_gid)
+            except OSError:
+                pass
+            os.chmod(path, st.st_mode & 07777)
+            os.utime(path, (st.st_atime, st.st_mtime))
+        if st.type != 'S_IFDIR':
+            self.stats.files += 1
+            self.journal.add(path)
+
+    def _fail(self, path, e):
+        print >> sys.stderr, '%s: %s' % (path, e)
+        self.errors.append((path, str(e)))
+        self.stats.failed += 1
+
+    def _stats(self):
+        s = OODict(self.stats)
+        s.errors = list(self.errors)
+        s.seconds = max(time.time() - self.start, 1e-6)
+        s.files_per_sec = s.files / s.seconds
+        s.mb_per_sec = s.bytes / s.seconds / 1e6
+        return s
+
+
+def copy_tree(fs, src, dest, workers = None, journal = None, report = 10):
+    """
+    Copy the tree under path src of fs to the local directory dest, keeping
+    permissions, owners, times and holes
+
+        @workers    ranges of files copied at the same time, default to
+                    conf.copy_workers
+        @journal    path of a journal, files copied are recorded in it and
+                    skipped when copy_tree is run again
+        @report     seconds between progress reports on stderr, 0 for none
+
+    Returns
+        OODict of files dirs skipped failed bytes seconds files_per_sec
+        mb_per_sec, errors is [(path, reason)] of the failed ones. None if src
+        is not found
+    """
+    return TreeCopy(fs, workers, journal, report).copy(src, dest)
+
+
+if __name__ == '__main__':
+    from zpool import ZPool
+    if len(sys.argv) < 4:
+        print >> sys.stderr, 'usage: python -m zfspy.extract pool/dataset path dest [workers]'
+        sys.exit(1)
+    opened = ZPool.open_dataset(sys.argv[1])
+    if not opened:
+        sys.exit(1)
+    pool, fs = opened
+    dest = sys.argv[3]
+    workers = None
+    if len(sys.argv) > 4:
+        workers = int(sys.argv[4])
+    s = copy_tree(fs, sys.argv[2], dest, workers, dest.rstrip('/') + '.journal')
+    pool.close()
+    if not s:
+        sys.exit(1)
+    print >> sys.stderr, '%d files %d dirs %d skipped %d failed %d bytes in %.1fs, %.0f files/s %.1f MB/s' % \
+            (s.files, s.dirs, s.skipped, s.failed, s.bytes, s.seconds, s.files_per_sec, s.mb_per_sec)
+    if s.failed:
+        sys.exit(1)
@@ -0,0 +1,93 @@
+"""
+ZFSpy: Python bindings for ZFS
+
+Copyright (C) 2008 Chen Zheng <nkchenz@gmail.com>
+
+This file is licensed under the terms of the GNU General Public License
+version 2. This program is licensed "as is" without any warranty of any
+kind, whether express or implied.
+
+Layouts of the on-disk structures. Each one is a precompiled struct, a whole
+structure is decoded by one unpack_from at an offset of the block it lives in,
+nothing is sliced or copied.
+"""
+from struct import Struct
+
+
+class Layout(Struct):
+    """
+    Layout
+        a precompiled struct format, with the names of the fields it decodes
+
+    Examples:
+        >>> l = Layout('pair', '=IQ', 'a b')
+        >>> l.size, l.unpack_from('\\x00' * 4 + '\\x01\\x00\\x00\\x00\\x02' + '\\x00' * 7, 4)
+        (12, (1, 2))
+        >>> l
+        <Layout 'pair 12 bytes: a b'>
+    """
+
+    def __init__(self, name, fmt, fields):
+        Struct.__init__(self, fmt)
+        self.name = name
+        self.fields = fields.split()
+
+    def __repr__(self):
+        return '<Layout \'%s %d bytes: %s\'>' % (self.name, self.size, ' '.join(self.fields))
+
+
+# All the structures are in native byte order, the same as StreamUnpacker
+
+UBERBLOCK = Layout('uberblock', '=5Q',
+    'ub_magic ub_version ub_txg ub_guid_sum ub_timestamp') # ub_rootbp follows
+
+BLKPTR = Layout('blkptr', '=7Q24x6Q',
+    'dva0_word0 dva0_word1 dva1_word0 dva1_word1 dva2_word0 dva2_word1 '
+    'prop birth_txg fill_count checksum0 checksum1 checksum2 checksum3')
+
+DNODE_PHYS = Layout('dnode_phys', '=7Bx2H4x2Q32x',
+    'type indblkshift nlevels nblkptr bonustype checksum compress '
+    'datablkszsec bonuslen maxblkid secphys') # dn_blkptr[nblkptr] and bonus follow
+
+OBJSET_TYPE = Layout('objset_phys.os_type', '=Q', 'os_type')
+
+ZNODE_PHYS = Layout('znode_phys', '=18Q',
+    'atime0 atime1 mtime0 mtime1 ctime0 ctime1 crtime0 crtime1 '
+    'gen mode size parent links xattr rdev flags uid gid')
+
+ACL_PHYS = Layout('zfs_acl_phys', '=QIH', 'z_acl_extern_obj z_acl_count z_acl_version')
+
+ACE_PHYS = Layout('zfs_oldace', '=QI2H', 'a_who a_access_mask a_flags a_type')
+
+DSL_DIR_PHYS = Layout('dsl_dir_phys', '=12Q',
+    'dd_creation_time dd_head_dataset_obj dd_parent_obj dd_origin_obj '
+    'dd_child_dir_zapobj dd_used_bytes dd_compressed_bytes dd_uncompressed_bytes '
+    'dd_quota dd_reserved dd_props_zapobj dd_deleg_zapobj')
+
+DSL_DATASET_PHYS = Layout('dsl_dataset_phys', '=16Q',
+    'ds_dir_obj ds_prev_snap_obj ds_prev_snap_txg ds_next_snap_obj '
+    'ds_snapnames_zapobj ds_num_children ds_creation_time ds_creation_txg '
+    'ds_deadlist_obj ds_used_bytes ds_compressed_bytes ds_uncompressed_bytes '
+    'ds_unique_bytes ds_fsid_guid ds_guid ds_flags') # ds_bp at 128
+
+MZAP_ENT = Layout('mzap_ent_phys', '=QIH50s', 'mze_value mze_cd mze_pad mze_name')
+
+ZAP_TYPE = Layout('zap block type', '=Q', 'zap_block_type')
+
+ZAP_PHYS = Layout('zap_phys', '=11Q',
+    'zap_block_type zap_magic zt_blk zt_numblks zt_shift zt_nextblk zt_blks_copied '
+    'zap_freeblk zap_num_leafs zap_num_entries zap_salt')
+
+ZAP_LEAF_HEADER = Layout('zap_leaf_header', '=3QI4H12x',
+    'lh_block_type lh_pad1 lh_prefix lh_magic lh_nfree lh_nentries lh_prefix_len lh_freelist')
+
+ZAP_LEAF_ENTRY = Layout('zap_leaf_entry', '=2B5HIQ',
+    'le_type le_int_size le_next le_name_chunk le_name_length le_value_chunk '
+    'le_value_length le_cd le_hash')
+
+ZAP_LEAF_ARRAY = Layout('zap_leaf_array', '=B21sH', 'la_type la_array la_next')
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
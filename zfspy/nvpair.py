@@ -40,6 +40,20 @@ DATA_TYPE = [
 'DATA_TYPE_UINT8_ARRAY'
 ]
 
+# struct format and size of the fixed size types
+FORMATS = {
+'byte': ('B', 1),
+'int8': ('b', 1),
+'uint8': ('B', 1),
+'int16': ('h', 2),
+'uint16': ('H', 2),
+'int32': ('i', 4),
+'uint32': ('I', 4),
+'int64': ('q', 8),
+'uint64': ('Q', 8),
+'hrtime': ('Q', 8),
+}
+
 class StreamUnpacker(object):
     """
     StreamUnpacker is a handy way to unpack data to objects 
@@ -79,6 +93,10 @@ class StreamUnpacker(object):
             self.repeat('uinit64', 3) excute self.uint64 3 times, so a 3 elements 
             tuple is returned.
         """
+        if attr in FORMATS:
+            # fixed size integers, unpack them all at one time
+            fmt, size = FORMATS[attr]
+            return self.unpack('%d%s' % (n, fmt), size * n)
         v = []
         for i in range(n):
             v.append(getattr(self, attr)())
@@ -214,9 +232,9 @@ class NVPair(object):
 
     """
 
-    def __init__(self):
+    def __init__(self, lazy = False):
         self.su = None
-        pass
+        self.lazy = lazy # decode nested nvlists as NVList
 
     def _do_unpack(self, data):
         su = StreamUnpacker(data)
@@ -233,7 +251,10 @@ class NVPair(object):
         xdr = {}
         xdr['nvh_encoding'] = encoding
         xdr['nvh_endian'] = endian
-        xdr['value'] = self._nvlist_decode()
+        if self.lazy:
+            xdr['value'] = NVList(su.data, su.pos, endian)
+        else:
+            xdr['value'] = self._nvlist_decode()
         return xdr
     
     def _nvlist_end(self):
@@ -292,6 +313,10 @@ class NVPair(object):
 
     def _elements_decode(self, type):
         if 'NVLIST' in type:
+            if self.lazy:
+                nvl = NVList(self.su.data, self.su.pos, self.su.endian)
+                self.su.pos = nvl._end
+                return nvl
             return self._nvlist_decode()
         # Thank python, here is the magic!
         attr = type.split('_')[2].lower()
@@ -335,6 +360,115 @@ class NVPair(object):
     @classmethod
     def unpack(cls, data):
         return  NVPair()._do_unpack(data)
+
+    @classmethod
+    def unpack_lazy(cls, data):
+        """
+        Unpack data to a NVList, nothing but the pair headers of the top level
+        nvlist is decoded until it's accessed
+
+        Returns
+            NVList, None if data is not xdr encoded
+        """
+        xdr = NVPair(lazy = True)._do_unpack(data)
+        if xdr:
+            return xdr['value']
+        return None
+
+
+class NVList(object):
+    """
+    NVList
+        a nvlist decoded on demand, works like the OODict NVPair.strip returns
+
+    The pair headers are scanned first, every pair is skipped by its encoded_sz,
+    which gives us a name to offset index. A value is decoded the first time it's
+    accessed, a nested nvlist becomes another NVList, whose pairs are not even
+    scanned until it's accessed.
+    """
+
+    def __init__(self, data, pos, endian):
+        """
+        @pos    where nvl_version of the nvlist is in data
+        """
+        self._data = data
+        self._endian = endian
+        self._start = pos
+        self._names = []
+        self._index = {} # name: offset of the pair
+        self._values = {}
+        su = StreamUnpacker(data)
+        su.endian = endian
+        su.pos = pos
+        self._version, self._flag = su.repeat('uint32', 2)
+        while True:
+            start = su.pos
+            encoded_sz, decoded_sz = su.repeat('uint32', 2)
+            if encoded_sz == 0 and decoded_sz == 0:
+                break # endmark
+            name = su.string()
+            self._names.append(name)
+            self._index[name] = start
+            su.pos = start + encoded_sz
+        self._end = su.pos
+
+    def __getitem__(self, name):
+        if name in self._values:
+            return self._values[name]
+        nvp = NVPair(lazy = True)
+        nvp.su = StreamUnpacker(self._data)
+        nvp.su.endian = self._endian
+        nvp.su.pos = self._index[name]
+        value = nvp._single_pair_decode()['value']
+        self._values[name] = value
+        return value
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __contains__(self, name):
+        return name in self._index
+
+    def __len__(self):
+        return len(self._names)
+
+    def __iter__(self):
+        return iter(self._names)
+
+    def keys(self):
+        return list(self._names)
+
+    def values(self):
+        return [self[name] for name in self._names]
+
+    def items(self):
+        return [(name, self[name]) for name in self._names]
+
+    def get(self, name, default = None):
+        if name in self._index:
+            return self[name]
+        return default
+
+    def strip(self):
+        """
+        Decode everything to an OODict, just like NVPair.strip
+        """
+        striped = OODict()
+        for name, value in self.items():
+            if isinstance(value, NVList):
+                value = value.strip()
+            elif isinstance(value, list) and value and isinstance(value[0], NVList):
+                value = [v.strip() for v in value]
+            striped[name] = value
+        return striped
+
+    def __repr__(self):
+        return repr(self.strip())
         
 
 if __name__ == '__main__':
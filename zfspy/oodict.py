@@ -7,6 +7,7 @@ This file is licensed under the terms of the GNU General Public License
 version 2. This program is licensed "as is" without any warranty of any
 kind, whether express or implied.
 """
+from collections import namedtuple
 
 class OODict(dict):
     """
@@ -41,6 +42,41 @@ class OODict(dict):
         self.__setitem__(key, value)
 
 
+def _make_record(cls, values):
+    return tuple.__new__(cls, values)
+
+def Record(name, fields):
+    """
+    Record
+        base class of compact, immutable records
+
+    A namedtuple, items are accessed like attributes, but there is no dict per
+    object. Use it for the structures we create millions of, subclasses set
+    __slots__ = () and parse the on-disk data in __new__, they build the tuple
+    by tuple.__new__(cls, values).
+
+    Examples:
+        >>> class Point(Record('Point', 'x y')):
+        ...     __slots__ = ()
+        ...     def __new__(cls, data):
+        ...         return tuple.__new__(cls, [int(i) for i in data.split(',')])
+        >>> p = Point('1,2')
+        >>> p.x, p.y, p._replace(y = 3)
+        (1, 2, Point(x=1, y=3))
+    """
+    base = namedtuple(name, fields)
+
+    class _Record(base):
+        __slots__ = ()
+
+        def __reduce__(self):
+            # __new__ of subclasses parses data, don't call it with our fields
+            return (_make_record, (self.__class__, tuple(self)))
+
+    _Record.__name__ = name + 'Record'
+    return _Record
+
+
 if __name__ == "__main__":
     import doctest
     doctest.testmod()
@@ -9,17 +9,21 @@ kind, whether express or implied.
 """
 import os
 from nvpair import NVPair, StreamUnpacker
-from oodict import OODict
+from oodict import OODict, Record
 from util import *
 from zio import ZIO
+from compress import ZIO_COMPRESS
+from layout import UBERBLOCK, BLKPTR
 
 UBERBLOCK_SHIFT = 10
 UBERBLOCK_SIZE = 1 << UBERBLOCK_SHIFT
 VDEV_UBERBLOCK_COUNT = 128 << 10 >> UBERBLOCK_SHIFT
 SPA_MINBLOCKSHIFT = 9
 VDEVLABEL_SIZE = 256 << 10
+EMPTY_BLKPTR = '\x00' * 128
+CHECKSUM = ['unknown', 'on', 'off', 'label', 'gang header', 'zilog', 'fletcher2', 'fletcher4', 'SHA-256']
 
-class UberBlock(OODict):
+class UberBlock(Record('UberBlock', 'ub_magic ub_version ub_txg ub_guid_sum ub_timestamp index ub_rootbp')):
     """ 
     uberblock:  168B
         uint64_t    ub_magic        0x00bab10c
@@ -40,12 +44,18 @@ class UberBlock(OODict):
          #define UBERBLOCK_SHIFT     10          /* up to 1K */
     
     So uberblock elements in array are all aligned to 1K, be carefull! 
+
+    index is the position in the uberblock array. ub_rootbp is None until
+    parsed by with_rootbp, most uberblocks are thrown away after comparing.
     """
+    __slots__ = ()
 
-    def __init__(self, data):
-        if data:
-            su = StreamUnpacker(data)
-            self.ub_magic, self.ub_version, self.ub_txg, self.ub_guid_sum, self.ub_timestamp = su.repeat('uint64', 5)
+    def __new__(cls, data, offset = 0):
+        return tuple.__new__(cls, UBERBLOCK.unpack_from(data, offset) + (offset / UBERBLOCK_SIZE, None))
+
+    def with_rootbp(self, data, offset = 0):
+        """Return a copy with ub_rootbp parsed from the uberblock at offset of data"""
+        return self._replace(ub_rootbp = BlockPtr(data, offset + UBERBLOCK.size))
     
     def valid(self):
         """check whether this ub is valid"""
@@ -70,7 +80,28 @@ class UberBlock(OODict):
         return '<UberBlock \'ub_txg %s ub_timestamp %s\'>' % (self.ub_txg, self.ub_timestamp)
 
 
-class BlockPtr(OODict):
+class DVA(Record('DVA', 'vdev grid asize G offset')):
+    """
+    data virtual address, see BlockPtr
+    """
+    __slots__ = ()
+
+    def __new__(cls, i, j):
+        """parse dva from its two words"""
+        return tuple.__new__(cls, (get_bits(i, 32, 32), get_bits(i, 24, 8),
+            get_bits(i, 0, 24) << SPA_MINBLOCKSHIFT, bool(get_bits(j, 63, 1)),
+            get_bits(j, 0, 63) << SPA_MINBLOCKSHIFT))
+
+# most block pointers use one or two dvas, the unused ones all share this
+EMPTY_DVA = DVA(0, 0)
+
+def parse_dva(i, j):
+    if i == 0 and j == 0:
+        return EMPTY_DVA
+    return DVA(i, j)
+
+
+class BlockPtr(Record('BlockPtr', 'dva lsize psize comp cksum type level endian birth_txg fill_count checksum')):
     """
     block: 128 b
         3 dvas
@@ -96,54 +127,37 @@ class BlockPtr(OODict):
 
     physical block address = offset << 9 + 4M
 
-    You can use BlockPtr() to create a empty block_ptr, please remeber
-    to initialize all its members. Always call with initial data is a preferd
-    way, zero data for empty block_ptr 
+    BlockPtr() is an empty block_ptr, a hole. Block pointers are immutable,
+    use _replace to get a modified copy.
     """
-
-
-    def __init__(self, data = None):
-        if data:
-            self.dva = []
-            dva_size = 16 
-            for dva in split_records(data[0 : dva_size * 3], dva_size):
-                self.dva.append(self._parse_dva(dva))
-            su = StreamUnpacker(data[dva_size * 3 :])
-            i = su.uint64()
-            #see lib/libzfscommon/include/sys/spa.h
-            self.lsize = (get_bits(i, 0, 16) + 1) << SPA_MINBLOCKSHIFT
-            self.psize = (get_bits(i, 16, 16) + 1) << SPA_MINBLOCKSHIFT
-            self.comp = get_bits(i, 32, 8)
-            self.cksum = get_bits(i, 40, 8)
-            self.type = get_bits(i, 48, 8)
-            self.level = get_bits(i, 56, 5)
-            if get_bits(i, 63, 1):
-                self.endian = '<' # little endian
-            else:
-                self.endian = '>' # big
-            self.cksum = ['unknown', 'on', 'off', 'label', 'gang header', 'zilog', 'fletcher2', 'fletcher4', 'SHA-256'][self.cksum]
-            self.comp = ['unknown', 'on', 'off', 'lzjb'][self.comp]
-            self.type = self.type
-            su.rewind(-24) # skip 24b paddings
-            self.birth_txg, self.fill_count = su.repeat('uint64', 2)
-            self.checksum = []
-            for i in range(4):
-                self.checksum.append(su.uint64())
-
-    def _parse_dva(self, data):
-        dva = OODict()
-        su = StreamUnpacker(data)
-        i = su.uint64()
-        dva.asize = get_bits(i, 0, 24) << SPA_MINBLOCKSHIFT
-        dva.grid = get_bits(i, 24, 8)
-        dva.vdev = get_bits(i, 32, 32)
-        i = su.uint64()
-        dva.offset = get_bits(i, 0, 63) << SPA_MINBLOCKSHIFT
+    __slots__ = ()
+
+    def __new__(cls, data = None, offset = 0):
+        if data is None:
+            data, offset = EMPTY_BLKPTR, 0
+        w = BLKPTR.unpack_from(data, offset)
+        i = w[6]
+        #see lib/libzfscommon/include/sys/spa.h
+        comp = get_bits(i, 32, 8)
+        if comp < len(ZIO_COMPRESS):
+            comp = ZIO_COMPRESS[comp]
+        else:
+            comp = 'unknown %d' % comp
         if get_bits(i, 63, 1):
-            dva.G = True
+            endian = '<' # little endian
         else:
-            dva.G = False
-        return dva
+            endian = '>' # big
+        return tuple.__new__(cls, (
+            (parse_dva(w[0], w[1]), parse_dva(w[2], w[3]), parse_dva(w[4], w[5])),
+            (get_bits(i, 0, 16) + 1) << SPA_MINBLOCKSHIFT, # lsize
+            (get_bits(i, 16, 16) + 1) << SPA_MINBLOCKSHIFT, # psize
+            comp,
+            CHECKSUM[get_bits(i, 40, 8)],
+            get_bits(i, 48, 8), # type
+            get_bits(i, 56, 5), # level
+            endian,
+            w[7], w[8], # birth_txg, fill_count
+            w[9:13]))
 
     def is_hole(self):
         """
@@ -183,7 +197,7 @@ class VDevLabel(object):
 
     def __init__(self, data = None):
         self.boot_header = None
-        self.nvlist = {}
+        self.nvlist_data = ''
         self.uberblocks = 0
         self.data = ''
         if data:
@@ -191,26 +205,27 @@ class VDevLabel(object):
 
     def _from_data(self, data):
         self.boot_header = data[8 << 10: 16 << 10]
-        self.nvlist = NVPair.unpack(data[16 << 10: 128 << 10])
-        self.data = NVPair.strip(self.nvlist['value'])
+        # only a few pairs are ever used, txg, pool_guid, vdev_tree..., decode them on demand
+        self.nvlist_data = view(data, 16 << 10, 112 << 10)
+        self.data = NVPair.unpack_lazy(self.nvlist_data)
 
         # find the active uberblock
         ub_array = data[128 << 10 :] 
         ubbest = None
-        i = 0
-        for data in split_records(ub_array, UBERBLOCK_SIZE):
-            ub = UberBlock(data)
-            ub.index = i
-            i = i + 1
+        for i in range(len(ub_array) / UBERBLOCK_SIZE):
+            ub = UberBlock(ub_array, i * UBERBLOCK_SIZE)
             if not ub.valid():
                 continue
             if ub.better_than(ubbest):
                 ubbest = ub
         # use index here so we don't have to parse blockptr for every ub, that saves a lot
-        data = get_record(ub_array, UBERBLOCK_SIZE, ubbest.index)
-        ubbest.ub_rootbp = BlockPtr(data[40: 168])
-        self.ubbest = ubbest
+        self.ubbest = ubbest.with_rootbp(ub_array, ubbest.index * UBERBLOCK_SIZE)
          
+    @property
+    def nvlist(self):
+        """the fully decoded nvlist"""
+        return NVPair.unpack(self.nvlist_data)
+
     def __repr__(self):
         return '<VDevLabel \'txg %s\'>' % self.data.txg 
 
@@ -239,6 +254,19 @@ class SPA(object):
         self.vdev_ubbest_load(self.vdev)
         debug('label best: %s' % self.labelbest.data)
 
+    def close(self):
+        """Close the handles of all the leaf vdevs"""
+        ZIO.close(self.leaf_paths(self.vdev))
+
+    def leaf_paths(self, vdev):
+        """Return paths of all the leaf vdevs under vdev"""
+        if 'children' not in vdev:
+            return [vdev.path]
+        paths = []
+        for node in vdev.children:
+            paths.extend(self.leaf_paths(node))
+        return paths
+
     def load_labels(self, dev):
         """
         Load vdev label informations, return the four labels
@@ -39,19 +39,28 @@ def hexprint(data):
         print
 
 
+def view(data, start, size):
+    """
+    Slice size bytes of data from start. If data is a buffer(for example a block
+    read from a mmaped vdev), the slice is a buffer too, nothing is copied.
+    """
+    if isinstance(data, buffer):
+        return buffer(data, start, size)
+    return data[start : start + size]
+
 def split_records(data, record_size):
     """
     Split records array into a record list
     """
     n = len(data) / record_size
     for i in range(n):
-        yield data[i * record_size : (i + 1) * record_size ]
+        yield view(data, i * record_size, record_size)
 
 def get_record(data, record_size, index):
     """
     get one record
     """
-    return data[index * record_size : (index + 1) * record_size ]
+    return view(data, index * record_size, record_size)
 
 def debug(s):
     if conf.debug:
@@ -0,0 +1,230 @@
+"""
+ZFSpy: Python bindings for ZFS
+
+Copyright (C) 2008 Chen Zheng <nkchenz@gmail.com>
+
+This file is licensed under the terms of the GNU General Public License
+version 2. This program is licensed "as is" without any warranty of any
+kind, whether express or implied.
+
+Vectorized decoding of whole blocks with NumPy, optional.
+
+An indirect block is viewed as an array of blkptr_t, a dnode block as an array
+of dnode_phys_t, the bit fields are then decoded by array operations into
+columns, one numpy array per field. Use them for bulk work, space accounting,
+filtering by birth txg, planning extents, instead of creating millions of
+BlockPtr objects.
+"""
+from oodict import OODict
+from layout import BLKPTR, DNODE_PHYS
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+SPA_MINBLOCKSHIFT = 9
+
+if numpy:
+    U = numpy.uint64 # numpy turns uint64 op int into float64, keep everything uint64
+
+    # native byte order, the same as layout
+    BLKPTR_DTYPE = numpy.dtype([
+        ('dva', '=u8', (3, 2)),
+        ('prop', '=u8'),
+        ('pad', 'V24'),
+        ('birth_txg', '=u8'),
+        ('fill_count', '=u8'),
+        ('checksum', '=u8', (4,)),
+    ])
+
+    # dn_blkptr is 3 block pointers here, the ones past dn_nblkptr are bonus
+    DNODE_DTYPE = numpy.dtype([
+        ('type', 'u1'),
+        ('indblkshift', 'u1'),
+        ('nlevels', 'u1'),
+        ('nblkptr', 'u1'),
+        ('bonustype', 'u1'),
+        ('checksum', 'u1'),
+        ('compress', 'u1'),
+        ('pad', 'u1'),
+        ('datablkszsec', '=u2'),
+        ('bonuslen', '=u2'),
+        ('pad2', 'V4'),
+        ('maxblkid', '=u8'),
+        ('secphys', '=u8'),
+        ('pad3', 'V32'),
+        ('blkptr', BLKPTR_DTYPE, (3,)),
+        ('bonus', 'V64'),
+    ])
+
+    assert BLKPTR_DTYPE.itemsize == BLKPTR.size == 128
+    assert DNODE_DTYPE.itemsize == 512
+
+
+def _check():
+    if numpy is None:
+        raise ImportError('numpy is needed for vectorized decoding')
+
+
+def _bits(a, start, len):
+    """get_bits for arrays"""
+    return (a >> U(start)) & U((1 << len) - 1)
+
+
+def _blkptr_columns(bps):
+    """
+    Decode an array of BLKPTR_DTYPE, of any shape, to columns. dva fields
+    have one more axis of 3, for the 3 dvas
+    """
+    prop = bps['prop']
+    w0 = bps['dva'][..., 0]
+    w1 = bps['dva'][..., 1]
+    c = OODict()
+    c.lsize = (_bits(prop, 0, 16) + U(1)) << U(SPA_MINBLOCKSHIFT)
+    c.psize = (_bits(prop, 16, 16) + U(1)) << U(SPA_MINBLOCKSHIFT)
+    c.comp = _bits(prop, 32, 8).astype(numpy.uint8) # index of compress.ZIO_COMPRESS
+    c.cksum = _bits(prop, 40, 8).astype(numpy.uint8)
+    c.type = _bits(prop, 48, 8).astype(numpy.uint8)
+    c.level = _bits(prop, 56, 5).astype(numpy.uint8)
+    c.little_endian = _bits(prop, 63, 1).astype(bool)
+    c.birth_txg = bps['birth_txg']
+    c.fill_count = bps['fill_count']
+    c.checksum = bps['checksum']
+    c.asize = _bits(w0, 0, 24) << U(SPA_MINBLOCKSHIFT)
+    c.grid = _bits(w0, 24, 8).astype(numpy.uint8)
+    c.vdev = _bits(w0, 32, 32).astype(numpy.uint32)
+    c.offset = _bits(w1, 0, 63) << U(SPA_MINBLOCKSHIFT)
+    c.gang = _bits(w1, 63, 1).astype(bool)
+    c.hole = c.birth_txg == 0
+    return c
+
+
+def blkptr_columns(data):
+    """
+    Decode all the block pointers of an indirect block
+
+        @data   the decompressed indirect block, or anything of n * 128 bytes
+
+    Returns
+        OODict of arrays of n items:
+            lsize psize comp cksum type level little_endian birth_txg
+            fill_count hole, checksum of (n, 4), and the dva fields asize
+            grid vdev offset gang of (n, 3)
+    """
+    _check()
+    bps = numpy.frombuffer(data, dtype = BLKPTR_DTYPE, count = len(data) / BLKPTR.size)
+    return _blkptr_columns(bps)
+
+
+def dnode_columns(data):
+    """
+    Decode all the dnodes of a dnode block
+
+        @data   a level 0 block of the meta dnode, n * 512 bytes
+
+    Returns
+        OODict of arrays of n items, the dnode_phys_t fields: type (index of
+        dmu.DMU_OBJTYPE) indblkshift nlevels nblkptr bonustype checksum compress
+        datablkszsec bonuslen maxblkid secphys. blkptr is the columns of the
+        block pointers, of (n, 3), blkptr.valid tells which of them are block
+        pointers rather than bonus.
+    """
+    _check()
+    dn = numpy.frombuffer(data, dtype = DNODE_DTYPE, count = len(data) / DNODE_DTYPE.itemsize)
+    c = OODict()
+    for name in DNODE_PHYS.fields:
+        c[name] = dn[name]
+    c.blkptr = _blkptr_columns(dn['blkptr'])
+    c.blkptr.valid = numpy.arange(3) < dn['nblkptr'][:, None]
+    return c
+
+
+def extents(c, dva = 0):
+    """
+    Sort the non hole block pointers of columns c by (vdev, offset) of a dva,
+    the order to read them in
+
+    Returns
+        (index, vdev, offset, asize) arrays
+    """
+    _check()
+    index = numpy.nonzero(~c.hole)[0]
+    vdev = c.vdev[index, dva]
+    offset = c.offset[index, dva]
+    order = numpy.lexsort((offset, vdev))
+    index = index[order]
+    return index, c.vdev[index, dva], c.offset[index, dva], c.asize[index, dva]
+
+
+# the columns are checked field by field against the scalar parsers, only
+# when numpy is there
+__test__ = {}
+if numpy:
+    __test__['columns'] = """
+    Random block pointers, some of them holes, make an indirect block:
+        >>> import random
+        >>> from spa import BlockPtr, CHECKSUM
+        >>> from compress import ZIO_COMPRESS
+        >>> from dmu import DNode, DMU_OBJTYPE
+        >>> random.seed(12)
+        >>> def blkptr():
+        ...     w = [random.getrandbits(64) for i in range(13)]
+        ...     for i in (1, 3, 5): # offsets of less than 2 ** 64 bytes, and the gang bit
+        ...         w[i] = w[i] & (1 << 63 | (1 << 55) - 1)
+        ...     comp, cksum = random.randrange(len(ZIO_COMPRESS)), random.randrange(len(CHECKSUM))
+        ...     w[6] = w[6] & ~(0xffff << 32) | comp << 32 | cksum << 40
+        ...     if random.random() < 0.2:
+        ...         w[7] = 0
+        ...     return BLKPTR.pack(*w)
+        >>> def blkptr_diff(bp, c, i):
+        ...     columns = [
+        ...         ('dva', tuple([(c.vdev[i + (k,)], c.grid[i + (k,)], c.asize[i + (k,)],
+        ...             c.gang[i + (k,)], c.offset[i + (k,)]) for k in range(3)])),
+        ...         ('lsize', c.lsize[i]), ('psize', c.psize[i]),
+        ...         ('comp', ZIO_COMPRESS[c.comp[i]]), ('cksum', CHECKSUM[c.cksum[i]]),
+        ...         ('type', c.type[i]), ('level', c.level[i]),
+        ...         ('endian', c.little_endian[i] and '<' or '>'),
+        ...         ('birth_txg', c.birth_txg[i]), ('fill_count', c.fill_count[i]),
+        ...         ('checksum', tuple(c.checksum[i]))]
+        ...     diff = [name for name, value in columns if value != getattr(bp, name)]
+        ...     if c.hole[i] != bp.is_hole():
+        ...         diff.append('hole')
+        ...     return diff
+        >>> data = ''.join([blkptr() for i in range(64)])
+        >>> c = blkptr_columns(data)
+        >>> len(c.lsize), c.vdev.shape
+        (64, (64, 3))
+        >>> [(i, blkptr_diff(BlockPtr(data, i * 128), c, (i,))) for i in range(64)
+        ...         if blkptr_diff(BlockPtr(data, i * 128), c, (i,))]
+        []
+
+    And a block of dnodes, the block pointers past nblkptr are bonus:
+        >>> def dnode():
+        ...     nblkptr = random.randint(1, 3)
+        ...     core = DNODE_PHYS.pack(random.randrange(len(DMU_OBJTYPE)), 14, random.randint(1, 6),
+        ...             nblkptr, random.randrange(256), 7, random.randrange(256),
+        ...             random.randint(1, 256), 64 * (3 - nblkptr) + 64,
+        ...             random.getrandbits(64), random.getrandbits(64))
+        ...     return core + ''.join([blkptr() for i in range(3)]) + '\\xbb' * 64
+        >>> data = ''.join([dnode() for i in range(32)])
+        >>> c = dnode_columns(data)
+        >>> diff = []
+        >>> for i in range(32):
+        ...     dn = DNode(None, data, i * 512)
+        ...     if DMU_OBJTYPE[c.type[i]] != dn.type:
+        ...         diff.append((i, 'type'))
+        ...     for name in DNODE_PHYS.fields[1:]:
+        ...         if c[name][i] != getattr(dn, name):
+        ...             diff.append((i, name))
+        ...     if list(c.blkptr.valid[i]) != [k < dn.nblkptr for k in range(3)]:
+        ...         diff.append((i, 'valid'))
+        ...     for k, bp in enumerate(dn.blkptr):
+        ...         diff.extend([(i, k, d) for d in blkptr_diff(bp, c.blkptr, (i, k))])
+        >>> diff
+        []
+    """
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
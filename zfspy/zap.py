@@ -7,10 +7,14 @@ This file is licensed under the terms of the GNU General Public License
 version 2. This program is licensed "as is" without any warranty of any
 kind, whether express or implied.
 """
+from struct import Struct, unpack
+from itertools import imap
 from nvpair import NVPair, StreamUnpacker
 from util import *
 from oodict import *
 from zio import *
+from engine import engine
+from layout import MZAP_ENT, ZAP_TYPE, ZAP_PHYS, ZAP_LEAF_HEADER, ZAP_LEAF_ENTRY, ZAP_LEAF_ARRAY
 
 ZAP_OBJ_TYPE = [
 'DMU_OT_OBJECT_DIRECTORY',
@@ -29,6 +33,54 @@ ZBT_LEAF = (1 << 63) + 0
 
 MZAP_ENT_LEN = 64
 MZAP_NAME_LEN = (MZAP_ENT_LEN - 8 - 4 - 2)
+MZAP_NAME_OFFSET = MZAP_ENT_LEN - MZAP_NAME_LEN
+
+ZAP_MAGIC = 0x2F52AB2AB
+ZAP_LEAF_MAGIC = 0x2AB1EAF
+ZAP_HASHBITS = 28
+
+ZAP_LEAF_CHUNKSIZE = 24
+ZAP_LEAF_ARRAY_BYTES = ZAP_LEAF_CHUNKSIZE - 3
+ZAP_LEAF_HEADER_SIZE = 2 * ZAP_LEAF_CHUNKSIZE
+ZAP_CHUNK_FREE = 253
+ZAP_CHUNK_ENTRY = 252
+ZAP_CHUNK_ARRAY = 251
+CHAIN_END = 0xffff
+
+# integers in leaf arrays are big endian, whatever the host is
+ZAP_INT_FORMAT = {2: 'H', 4: 'I', 8: 'Q'}
+
+UINT16 = Struct('=H')
+UINT64 = Struct('=Q')
+
+ZFS_CRC64_POLY = 0xC96C5795D7870F42
+
+def _crc64_table():
+    table = []
+    for i in range(256):
+        ct = i
+        for j in range(8):
+            ct = (ct >> 1) ^ (ZFS_CRC64_POLY if ct & 1 else 0)
+        table.append(ct)
+    return table
+
+ZFS_CRC64_TABLE = _crc64_table()
+
+def zap_hash(salt, name):
+    """
+    zap_hash, crc64 of name salted by the zap, only the highest ZAP_HASHBITS bits
+    are kept
+
+    Examples:
+        >>> '%x' % zap_hash(0x1234, 'ROOT')
+        'b4b70a2000000000'
+    """
+    crc = salt
+    table = ZFS_CRC64_TABLE
+    for c in name:
+        crc = (crc >> 8) ^ table[(crc ^ ord(c)) & 0xff]
+    return crc & ~((1 << (64 - ZAP_HASHBITS)) - 1)
+
 
 class ZAP(object):
     """
@@ -44,36 +96,73 @@ class ZAP(object):
         uint32_t mze_cd;
         uin16_t mze_pad;
         char mze_name[MZAP_NAME_LEN];
+
+    fatzap:
+        block 0 is the zap_phys_t header, the pointer table maps the highest
+        zt_shift bits of a name hash to the leaf block holding it. Small tables
+        are embedded in the second half of the header block, larger ones take
+        zt_numblks blocks from zt_blk. Leaves hash the name again to a chain of
+        entry chunks, names and values are chains of array chunks.
+
+    Look up one name by lookup(name), a microzap then decodes only the entry
+    of the name, a fatzap reads only the header, one block of the pointer table
+    and one leaf. entries decodes all of it.
     """
 
-    def __init__(self, data):
-        self.type = StreamUnpacker(data[:8]).uint64()
+    def __init__(self, data, dnode = None):
+        """
+            @data   block 0 of the zap object
+            @dnode  the zap object, a fatzap reads its other blocks from it
+        """
+        self.type = ZAP_TYPE.unpack_from(data)[0]
+        self.dnode = dnode
+        self._entries = None
         if self.type == ZBT_MICRO:
             debug('mzap init')
             self._mzap(data)
+        elif self.type == ZBT_HEADER:
+            debug('fatzap init')
+            self._fatzap(data)
         else:
-            # fat zap here
             print 'type=%x zap found' % self.type
             hexprint(data)
-            pass
+            self._entries = OODict()
 
     def _mzap(self, data):
         self.salt = StreamUnpacker(data[8:16]).uint64()
-        self.entries = OODict()
-        for ent in split_records(data[64:], MZAP_ENT_LEN):
-            value = StreamUnpacker(ent[:8]).uint64()
-            name = ent[14:MZAP_NAME_LEN].strip('\00')
+        # entries are decoded on demand, straight from the block
+        if not isinstance(data, str):
+            data = str(data) # buffers of a mmaped vdev can't find
+        self.data = data
+
+    def _mzap_items(self):
+        data = self.data
+        for i in range(1, len(data) / MZAP_ENT_LEN):
+            value, cd, pad, name = MZAP_ENT.unpack_from(data, i * MZAP_ENT_LEN)
+            name = name.split('\00')[0]
             if name:
-                self.entries[name] = value
-        debug('mzap entries: %s' % self.entries)
+                yield name, value
+
+    def _mzap_lookup(self, name):
+        """
+        Find name + NUL at the name field of an entry, only that entry is decoded
+        """
+        if not name or len(name) >= MZAP_NAME_LEN:
+            return None
+        key = name + '\0'
+        data = self.data
+        pos = data.find(key, MZAP_ENT_LEN)
+        while pos >= 0:
+            offset = pos - MZAP_NAME_OFFSET
+            if offset % MZAP_ENT_LEN == 0:
+                return UINT64.unpack_from(data, offset)[0]
+            pos = data.find(key, pos + 1)
+        return None
 
     @classmethod
     def from_dnode(cls, objset, i):
         dnode = objset.get_object(i)
-        bp = dnode.blkptr[0]
-        zap = ZAP(ZIO.read_blk(objset.vdev, bp))
-        zap.dnode = dnode # we'd better to save the dnode we came from
-        return zap
+        return ZAP(dnode.get_blk(0), dnode) # we'd better to save the dnode we came from
 
     def _fatzap(self, data):
         """
@@ -94,10 +183,219 @@ class ZAP(object):
         zap_pad 8181
         zap_leafs 8192
         """
-        pass
+        (block_type, magic, self.zt_blk, self.zt_numblks, self.zt_shift, self.zt_nextblk,
+            self.zt_blks_copied, self.freeblk, self.num_leafs, self.num_entries,
+            self.salt) = ZAP_PHYS.unpack_from(data)
+        if magic != ZAP_MAGIC:
+            print 'bad fatzap magic %x' % magic
+        self.block_shift = len(data).bit_length() - 1
+        self.header = data
+        debug('fatzap shift %d ptrtbl blk %d numblks %d shift %d leafs %d entries %d' % \
+                (self.block_shift, self.zt_blk, self.zt_numblks, self.zt_shift, self.num_leafs, self.num_entries))
+
+    def _ptrtbl(self, index):
+        """
+        Block id of the leaf at index of the pointer table
+        """
+        if not self.zt_numblks:
+            # embedded, the second half of the header
+            return UINT64.unpack_from(self.header, (len(self.header) >> 1) + index * 8)[0]
+        ptr_per_blk = 1 << (self.block_shift - 3)
+        data = self.dnode.get_blk(self.zt_blk + index / ptr_per_blk)
+        if data is None:
+            return None
+        return UINT64.unpack_from(data, (index % ptr_per_blk) * 8)[0]
+
+    def _leaf(self, data):
+        """
+        Check a leaf block
+
+        Returns
+            (offset of chunk 0, hash buckets, prefix_len), or None if it's not a leaf
+        """
+        block_type, pad, prefix, magic, nfree, nentries, prefix_len, freelist = \
+                ZAP_LEAF_HEADER.unpack_from(data)
+        if block_type != ZBT_LEAF or magic != ZAP_LEAF_MAGIC:
+            return None
+        buckets = 1 << (self.block_shift - 5)
+        return ZAP_LEAF_HEADER_SIZE + 2 * buckets, buckets, prefix_len
+
+    def _array(self, data, chunks, chunk, size):
+        """
+        Read size bytes of the array starting at chunk
+        """
+        a = []
+        while size > 0 and chunk != CHAIN_END:
+            type, bytes, chunk = ZAP_LEAF_ARRAY.unpack_from(data, chunks + chunk * ZAP_LEAF_CHUNKSIZE)
+            a.append(bytes[:size])
+            size -= ZAP_LEAF_ARRAY_BYTES
+        return ''.join(a)
+
+    def _entry(self, data, chunks, entry):
+        """
+        Returns
+            (name, value) of a leaf entry. Strings are stored as 1 byte integers,
+            a single integer is returned as it is, more as a list
+        """
+        type, int_size, next, name_chunk, name_length, value_chunk, value_length, cd, hash = entry
+        name = self._array(data, chunks, name_chunk, name_length).split('\0')[0]
+        value = self._array(data, chunks, value_chunk, int_size * value_length)
+        if int_size == 1:
+            return name, value.split('\0')[0]
+        value = unpack('>%d%s' % (value_length, ZAP_INT_FORMAT[int_size]), value)
+        if value_length == 1:
+            value = value[0]
+        else:
+            value = list(value)
+        return name, value
+
+    def _leaf_items(self, data):
+        leaf = self._leaf(data)
+        if leaf is None:
+            return
+        chunks, buckets, prefix_len = leaf
+        for offset in xrange(chunks, len(data) - ZAP_LEAF_CHUNKSIZE + 1, ZAP_LEAF_CHUNKSIZE):
+            if ord(data[offset]) == ZAP_CHUNK_ENTRY:
+                yield self._entry(data, chunks, ZAP_LEAF_ENTRY.unpack_from(data, offset))
+
+    def lookup(self, name):
+        """
+        Look up the value of name
+
+        Returns
+            value, or None if name isn't in the zap
+        """
+        if self._entries is not None:
+            return self._entries.get(name)
+        if self.type == ZBT_MICRO:
+            return self._mzap_lookup(name)
+        hash = zap_hash(self.salt, name)
+        index = 0
+        if self.zt_shift:
+            index = hash >> (64 - self.zt_shift)
+        blkid = self._ptrtbl(index)
+        if blkid is None:
+            return None
+        data = self.dnode.get_blk(blkid)
+        if data is None:
+            return None
+        leaf = self._leaf(data)
+        if leaf is None:
+            print 'bad zap leaf %d' % blkid
+            return None
+        chunks, buckets, prefix_len = leaf
+        bucket = (buckets - 1) & (hash >> (64 - (self.block_shift - 5) - prefix_len))
+        chunk = UINT16.unpack_from(data, ZAP_LEAF_HEADER_SIZE + bucket * 2)[0]
+        while chunk != CHAIN_END:
+            entry = ZAP_LEAF_ENTRY.unpack_from(data, chunks + chunk * ZAP_LEAF_CHUNKSIZE)
+            if entry[8] == hash:
+                k, v = self._entry(data, chunks, entry)
+                if k == name:
+                    return v
+            chunk = entry[2]
+        return None
+
+    def iteritems(self, prefetch = False):
+        """
+        Yield (name, value) of all the entries, a fatzap reads its leaves one by
+        one, only one leaf is held at a time.
+
+            @prefetch   read the next leaf while this one is decoded
+        """
+        if self._entries is not None:
+            return self._entries.iteritems()
+        if self.type == ZBT_MICRO:
+            return self._mzap_items()
+        return self._fat_items(prefetch)
+
+    def _fat_items(self, prefetch = False):
+        dnode = self.dnode
+        read = lambda (blkid, bp): ZIO.read_blk(dnode.vdev, bp)
+        # leaves and pointer table blocks follow the header, tell them by the leaf magic
+        bps = dnode.iter_blocks(1)
+        if prefetch:
+            leaves = engine.map(read, bps, 2)
+        else:
+            leaves = imap(read, bps)
+        for data in leaves:
+            if data is None:
+                continue
+            for item in self._leaf_items(data):
+                yield item
+
+    @property
+    def entries(self):
+        """
+        All the entries, name -> value
+        """
+        if self._entries is None:
+            self._entries = OODict(self.iteritems())
+            debug('zap entries: %s' % self._entries)
+        return self._entries
 
     def __repr__(self):
-        return '<ZAP %s>' % self.entries
+        if self.type == ZBT_MICRO:
+            return '<ZAP %s>' % self.entries
+        if self._entries is None:
+            return '<ZAP %d leafs %d entries>' % (self.num_leafs, self.num_entries)
+        return '<ZAP %s>' % self._entries
+
+
+__test__ = {'fatzap': """
+    A fatzap of 512 bytes blocks, the leaves have 16 hash buckets. The names
+    are split between two leaves by the highest bit of their hashes, 'b' and
+    'h', 'g' and 'tmp' share the 5 highest bits, so they are on the same
+    bucket chain of their leaf. 'x' * 50 takes three array chunks.
+
+        >>> import struct
+        >>> class Blocks(list):
+        ...     def get_blk(self, blkid):
+        ...         return self[blkid]
+        >>> def leaf(names, salt):
+        ...     buckets, chunks = [CHAIN_END] * 16, []
+        ...     def array(data):
+        ...         first = len(chunks)
+        ...         pieces = [data[i : i + 21] for i in range(0, len(data), 21)]
+        ...         for i, piece in enumerate(pieces):
+        ...             next = i + 1 < len(pieces) and first + i + 1 or CHAIN_END
+        ...             chunks.append(ZAP_LEAF_ARRAY.pack(ZAP_CHUNK_ARRAY, piece, next))
+        ...         return first
+        ...     for name, value in names:
+        ...         hash = zap_hash(salt, name)
+        ...         bucket = 15 & (hash >> (64 - 4 - 1))
+        ...         entry = len(chunks)
+        ...         chunks.append(None)
+        ...         name_chunk = array(name + '\\0')
+        ...         value_chunk = array(struct.pack('>Q', value))
+        ...         chunks[entry] = ZAP_LEAF_ENTRY.pack(ZAP_CHUNK_ENTRY, 8, buckets[bucket],
+        ...             name_chunk, len(name) + 1, value_chunk, 1, 0, hash)
+        ...         buckets[bucket] = entry
+        ...     data = ZAP_LEAF_HEADER.pack(ZBT_LEAF, 0, 0, ZAP_LEAF_MAGIC, 0, len(names), 1, CHAIN_END)
+        ...     data += struct.pack('=16H', *buckets) + ''.join(chunks)
+        ...     return data + '\\0' * (512 - len(data))
+        >>> leaf0 = leaf([('g', 7), ('tmp', 8), ('var', 9)], 0x1234)
+        >>> leaf1 = leaf([('b', 2), ('h', 3), ('x' * 50, 4)], 0x1234)
+
+    The pointer table embedded in the header, 32 entries of zt_shift 5:
+        >>> header = ZAP_PHYS.pack(ZBT_HEADER, ZAP_MAGIC, 0, 0, 5, 0, 0, 3, 2, 6, 0x1234)
+        >>> header += '\\0' * (256 - len(header)) + struct.pack('=32Q', *[1] * 16 + [2] * 16)
+        >>> z = ZAP(header, Blocks([header, leaf0, leaf1]))
+        >>> [z.lookup(name) for name in ('g', 'tmp', 'var', 'b', 'h', 'x' * 50)]
+        [7, 8, 9, 2, 3, 4]
+        >>> z.lookup('x' * 49), z.lookup('c'), z.lookup('')
+        (None, None, None)
+        >>> sorted(z._leaf_items(leaf1))
+        [('b', 2), ('h', 3), ('xxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxx', 4)]
+
+    The same leaves behind a pointer table of zt_shift 6 in block 1:
+        >>> header = ZAP_PHYS.pack(ZBT_HEADER, ZAP_MAGIC, 1, 1, 6, 0, 0, 4, 2, 6, 0x1234)
+        >>> header += '\\0' * (512 - len(header))
+        >>> table = struct.pack('=64Q', *[2] * 32 + [3] * 32)
+        >>> z = ZAP(header, Blocks([header, table, leaf0, leaf1]))
+        >>> [z.lookup(name) for name in ('g', 'tmp', 'var', 'b', 'h', 'x' * 50)]
+        [7, 8, 9, 2, 3, 4]
+        >>> z.lookup('c')
+    """}
 
 if __name__ == '__main__':
     import doctest
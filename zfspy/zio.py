@@ -8,10 +8,189 @@ version 2. This program is licensed "as is" without any warranty of any
 kind, whether express or implied.
 """
 
+import os
+import mmap
+import time
+import threading
+import conf
 from compress import *
+from cache import ARC
+
+
+class VDevHandle(object):
+    """
+    Open descriptors of a leaf device
+
+    Python 2 has no os.pread, a read seeks and reads on a descriptor nobody
+    else uses. Descriptors are checked out of a pool, and opened on demand,
+    at most max_fds of them are kept. Closing the handle closes the ones in
+    the pool, the ones in use are closed when their reads are done.
+
+    With use_mmap the whole device is mapped and the descriptor is closed at
+    once, reads return buffers of the mapping. The mapping lives as long as
+    any buffer of it does, so closing the handle never invalidates data
+    somebody still holds.
+    """
+
+    def __init__(self, dev, use_mmap = False, max_fds = 16):
+        self.dev = dev
+        fd = os.open(dev, os.O_RDONLY)
+        # st_size is 0 for block devices, seek to the end to get the real size
+        self.size = os.lseek(fd, 0, 2)
+        self.lock = threading.Lock()
+        self.last_used = time.time()
+        self.map = None
+        self.fds = [fd]
+        self.max_fds = max_fds
+        self.closed = False
+        if use_mmap and self.size:
+            self.map = mmap.mmap(fd, self.size, access = mmap.ACCESS_READ)
+            os.close(fd)
+            self.fds = []
+
+    def pread(self, offset, size):
+        """
+        Positional read, it never moves a file position another thread relies on
+        """
+        if self.map is not None:
+            if offset >= self.size:
+                return ''
+            return buffer(self.map, offset, size)
+        fd = self._get_fd()
+        try:
+            def read(n, off):
+                os.lseek(fd, off, 0)
+                return os.read(fd, n)
+            return self._read_all(read, offset, size)
+        finally:
+            self._put_fd(fd)
+
+    def _get_fd(self):
+        self.lock.acquire()
+        try:
+            if self.fds:
+                return self.fds.pop()
+        finally:
+            self.lock.release()
+        return os.open(self.dev, os.O_RDONLY)
+
+    def _put_fd(self, fd):
+        self.lock.acquire()
+        try:
+            if not self.closed and len(self.fds) < self.max_fds:
+                self.fds.append(fd)
+                return
+        finally:
+            self.lock.release()
+        os.close(fd)
+
+    def _read_all(self, read, offset, size):
+        # read(2) may return less than we want, keep going until eof
+        bufs = []
+        while size > 0:
+            buf = read(size, offset)
+            if not buf:
+                break
+            bufs.append(buf)
+            offset = offset + len(buf)
+            size = size - len(buf)
+        return ''.join(bufs)
+
+    def close(self):
+        self.lock.acquire()
+        try:
+            self.closed = True
+            fds, self.fds = self.fds, []
+        finally:
+            self.lock.release()
+        for fd in fds:
+            os.close(fd)
+        self.map = None
+
+
+class VDevHandles(object):
+    """
+    VDevHandles
+        keep one handle per leaf device path
+
+    Handles are opened on first use and shared by all the readers. A handle
+    not used for idle_timeout seconds is closed by the next read, all the
+    handles of a pool are closed when the pool is closed. conf.use_mmap and
+    conf.queue_depth are checked when a handle is opened.
+    """
+
+    def __init__(self, idle_timeout = None):
+        """
+            @idle_timeout   seconds, None to follow conf.vdev_idle_timeout
+        """
+        self.idle_timeout = idle_timeout
+        self.handles = {}
+        self.lock = threading.Lock()
+        self.last_expire = time.time()
+
+    def get(self, dev):
+        """
+        Get the handle of dev, open it if we haven't
+        """
+        self.lock.acquire()
+        try:
+            now = time.time()
+            if now - self.last_expire > self._timeout():
+                self._expire(now)
+            h = self.handles.get(dev)
+            if h is None:
+                h = VDevHandle(dev, conf.use_mmap, conf.queue_depth)
+                self.handles[dev] = h
+            h.last_used = now
+            return h
+        finally:
+            self.lock.release()
+
+    def _timeout(self):
+        if self.idle_timeout is None:
+            return conf.vdev_idle_timeout
+        return self.idle_timeout
+
+    def _expire(self, now):
+        timeout = self._timeout()
+        for dev, h in self.handles.items():
+            if now - h.last_used > timeout:
+                debug('close idle vdev %s' % dev)
+                h.close()
+                del self.handles[dev]
+        self.last_expire = now
+
+    def pread(self, dev, offset, size, how = 0):
+        """
+        read size data from dev + offset, see ZIO.read
+        """
+        h = self.get(dev)
+        if how == 2:
+            offset = h.size + offset
+        return h.pread(offset, size)
+
+    def close(self, devs = None):
+        """
+        Close handles of devs, or all the handles if devs is None
+        """
+        self.lock.acquire()
+        try:
+            if devs is None:
+                devs = self.handles.keys()
+            for dev in devs:
+                h = self.handles.pop(dev, None)
+                if h:
+                    h.close()
+        finally:
+            self.lock.release()
+
 
 class ZIO:
-    
+
+    # both follow conf, changes of it take effect at once
+    handles = VDevHandles()
+    cache = ARC()
+
     @classmethod
     def read_blk(cls, vdev, bp):
         """
@@ -19,27 +198,134 @@ class ZIO:
             @vdev       the vdev_tree in vdev_label, we need it to find the real dev
                         by dva[0].vdev index
             @bp         block pointer
+
+        Decompressed blocks are cached by (dev, offset, birth txg), a block is never
+        rewritten in place, so the key can't go stale.
+
+        Returns
+            data of the block, None if it's corrupted
+
+        Examples:
+            >>> import tempfile
+            >>> from spa import BlockPtr
+            >>> from oodict import OODict
+            >>> f = tempfile.NamedTemporaryFile()
+            >>> f.seek(1 << 22); f.write('\\xff' * 512); f.flush()
+            >>> bp = BlockPtr()._replace(comp = 'lzjb', birth_txg = 1)
+            >>> ZIO.read_blk(OODict({'path': f.name}), bp) # doctest: +ELLIPSIS
+            corrupted block <BlockPtr ... lzjb ... lsize=512 psize=512 ...>
+            >>> ZIO.close([f.name])
+        """
+        dev, key = cls._locate(vdev, bp)
+        if cls.cache is not None:
+            data = cls.cache.get(key)
+            if data is not None:
+                return data
+        data = cls.read(dev, key[1] + (1 << 22), bp.psize)
+        return cls._done(key, bp, data)
+
+    @classmethod
+    def read_blks(cls, vdev, bps, gap = None):
+        """
+        read the blocks pointed to by bps
+
+        Blocks are sorted by (dev, offset), blocks no more than gap bytes apart
+        are fetched by one large read, which is then split back into blocks.
+            @vdev       see read_blk
+            @bps        [BlockPtr]
+            @gap        bytes we'd rather read and throw away than seek over,
+                        conf.read_gap if None
+
+        Returns
+            [data] in the same order as bps
+        """
+        if gap is None:
+            gap = conf.read_gap
+        result = [None] * len(bps)
+        todo = []
+        for i, bp in enumerate(bps):
+            dev, key = cls._locate(vdev, bp)
+            if cls.cache is not None:
+                result[i] = cls.cache.get(key)
+                if result[i] is not None:
+                    continue
+            todo.append((dev, key[1], bp.psize, i, key))
+        todo.sort()
+
+        j = 0
+        while j < len(todo):
+            dev, start, size = todo[j][:3]
+            end = start + size
+            k = j + 1
+            while k < len(todo):
+                next_dev, next_start, next_size = todo[k][:3]
+                next_end = max(end, next_start + next_size)
+                if next_dev != dev or next_start > end + gap or next_end - start > conf.read_max:
+                    break
+                end = next_end
+                k = k + 1
+            debug('read_blks %s %x+%x: %d blocks' % (dev, start, end - start, k - j))
+            data = cls.read(dev, start + (1 << 22), end - start)
+            for dev, offset, size, i, key in todo[j:k]:
+                result[i] = cls._done(key, bps[i], view(data, offset - start, size))
+            j = k
+        return result
+
+    @classmethod
+    def _locate(cls, vdev, bp):
+        """
+        Find the dev of bp, and its cache key
         """
         dva = bp.dva[0] # Fixme, which dva should we use?
         if 'children' not in vdev:
             dev = vdev.path  # type file, disk
         else:
             dev = vdev.children[dva.vdev].path # type mirror
-        offset = dva.offset + (1 << 22)
-        data = cls.read(dev, offset, bp.psize)
-        if bp.comp == 'on' or bp.comp == 'lzjb':
-            data = lzjb_decompress(data)[:bp.lsize]
+        return dev, (dev, dva.offset, bp.birth_txg)
+
+    @classmethod
+    def _done(cls, key, bp, data):
+        """
+        Decompress data just read for bp, and cache it
+        """
+        data = decompress(bp.comp, data, bp.lsize)
+        if data is None:
+            print 'corrupted block %s' % (bp,)
+            return None
+        # buffers of a mmaped dev are already cached by the page cache
+        if cls.cache is not None and not isinstance(data, buffer):
+            cls.cache.put(key, data)
         return data
-        
+
+    @classmethod
+    def set_cache(cls, cache):
+        """
+        Replace the block cache, None to disable caching
+
+            @cache      an ARC, or anything has get(key) and put(key, data)
+        """
+        cls.cache = cache
+
     @classmethod
     def read(cls, dev, offset, size, how = 0):
         """
         read size data from dev + offset
            offset default relative to beginning
            how = 2 for end of the dev, otherwise not defined
+
+        Returns
+            String, or a buffer of the mapped dev if conf.use_mmap is on
         """
-        f = open(dev, 'rb')
-        f.seek(offset, how)
-        data = f.read(size)
-        f.close()
-        return data
+        return cls.handles.pread(dev, offset, size, how)
+
+    @classmethod
+    def close(cls, devs = None):
+        """
+        Close the cached handles of devs, all of them if devs is None
+        """
+        cls.handles.close(devs)
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -7,10 +7,17 @@ This file is licensed under the terms of the GNU General Public License
 version 2. This program is licensed "as is" without any warranty of any
 kind, whether express or implied.
 """
+import io
 from os.path import normpath, join
+from collections import deque
 from zap import *
 from nvpair import *
-from oodict import OODict
+from oodict import OODict, Record
+from engine import engine, walker
+from cache import LRU
+from dmu import DMU_OBJTYPE, DNODE_SIZE, DNODE_CORE_SIZE, BlockPtr_SIZE
+from layout import ZNODE_PHYS, ACL_PHYS, ACE_PHYS, DNODE_PHYS
+import conf
 
 ZPL_FILE_TYPE = {
 0x1: 'S_IFIFO',
@@ -36,77 +43,323 @@ ZPL_FLAG ={
 }
 
 ACL_T_SIZE = 16
+ZNODE_ACL_OFFSET = 176
+ZNODE_SIZE = 264 # znode_phys_t, with its ACL, short symlink targets follow
 
+DMU_OT_ZNODE = DMU_OBJTYPE.index('DMU_OT_ZNODE')
 
-class ZFile(OODict):
+# marks holes in the block buffer of ZFile
+HOLE = object()
 
-    def read(self):
-        id = 0
-        blk_size = self.dnode.datablkszsec << 9
-        data = ''
-        remain_len = self.znode.size 
-        while True:
-            buf = self.dnode.get_blk(id)
-            if id == self.dnode.maxblkid:
-                data += buf[:remain_len]
-                return data
-            else:
-                data += buf
+# entries ZFS.scandir stats at a time
+SCANDIR_BATCH = 1024
+
+
+def dirent_obj(value):
+    """
+    Object id of a directory entry, ZFS_DIRENT_OBJ
+    """
+    return get_bits(value, 0, 48)
+
+def dirent_type(value):
+    """
+    File type of a directory entry, ZFS_DIRENT_TYPE, the 4 highest bits are
+    the one of its mode. Old entries have none, they are None
+    """
+    return ZPL_FILE_TYPE.get(get_bits(value, 60, 4))
+
+
+class ZFile(io.RawIOBase):
+    """
+    ZFile
+        a regular file, read it like a file opened in 'rb' mode
+
+    read(n), readinto, seek and tell work from the current position, pread at
+    any offset, they fetch only the level 0 blocks covering the range asked for.
+    The last blocks are kept in a small buffer, reads smaller than a block don't
+    fetch it again. read() of the whole file streams all the blocks, pipelined
+    by the read engine, see blocks.
+    """
+
+    def __init__(self, dnode, znode, queue_depth = None):
+        """
+            @queue_depth    blocks in flight when the whole file is read,
+                            default to conf.queue_depth
+        """
+        io.RawIOBase.__init__(self)
+        self.dnode = dnode
+        self.znode = znode
+        self.queue_depth = queue_depth or conf.queue_depth
+        self.blk_size = dnode.datablkszsec << 9
+        self.pos = 0
+        self.buffer = LRU(conf.file_buffer_blocks) # blkid -> data, HOLE for holes
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def seek(self, offset, whence = io.SEEK_SET):
+        self._checkClosed()
+        if whence == io.SEEK_CUR:
+            offset += self.pos
+        elif whence == io.SEEK_END:
+            offset += self.znode.size
+        elif whence != io.SEEK_SET:
+            raise ValueError('invalid whence (%r)' % whence)
+        if offset < 0:
+            raise ValueError('negative seek position %d' % offset)
+        self.pos = offset
+        return self.pos
+
+    def tell(self):
+        self._checkClosed()
+        return self.pos
+
+    def blocks(self, queue_depth = None):
+        """
+        Yield data of the file block by block, in file order. DNode.iter_blocks
+        walks the block tree once, the level 0 blocks are fetched and decompressed
+        by the read engine, queue_depth of them at a time. With a queue depth of 1
+        they are read by ZIO.read_blks instead, adjacent blocks in one read.
+
+        Holes are yielded as zeros, without any I/O, the same zero string every
+        time, so sparse files cost only their allocated blocks. A block which
+        can't be read raises IOError.
+
+            @queue_depth    blocks in flight, default to the one of the ZFS we
+                            came from, or conf.queue_depth
+        """
+        if queue_depth is None:
+            queue_depth = self.queue_depth
+        dnode = self.dnode
+        if queue_depth > 1:
+            read = lambda (blkid, bp): (blkid, ZIO.read_blk(dnode.vdev, bp))
+            bufs = engine.map(read, dnode.iter_blocks(), queue_depth)
+        else:
+            bufs = dnode.iter_blocks(data = True)
+        blk_size = dnode.datablkszsec << 9
+        zero = '\0' * blk_size
+        remain_len = self.znode.size
+        next_blkid = 0
+        for blkid, buf in bufs:
+            while next_blkid < blkid and remain_len > 0:
+                yield zero[:remain_len]
                 remain_len -= blk_size
-            id += 1
+                next_blkid += 1
+            if remain_len <= 0:
+                break
+            if buf is None:
+                raise IOError('block %d can\'t be read' % blkid)
+            # blocks of a mmaped vdev are buffers, make them strings
+            buf = str(buf[:remain_len])
+            remain_len -= blk_size
+            next_blkid += 1
+            yield buf
+        # trailing holes
+        while remain_len > 0:
+            yield zero[:remain_len]
+            remain_len -= blk_size
+
+    def _get_blocks(self, first, end):
+        """
+        Data of level 0 blocks [first, end), HOLE for holes. The missing ones are
+        fetched by one walk of the block tree
+
+        Raises
+            IOError if a block can't be read
+        """
+        blocks = {}
+        missing = []
+        for blkid in xrange(first, end):
+            if blkid in self.buffer:
+                blocks[blkid] = self.buffer.get(blkid)
+            else:
+                missing.append(blkid)
+        if missing:
+            for blkid, data in self.dnode.iter_blocks(missing[0], missing[-1] + 1, True):
+                if data is None:
+                    raise IOError('block %d can\'t be read' % blkid)
+                blocks[blkid] = data
+            for blkid in missing:
+                # the ones iter_blocks skipped are holes
+                self.buffer.put(blkid, blocks.setdefault(blkid, HOLE))
+        return [blocks[blkid] for blkid in xrange(first, end)]
+
+    def pread(self, offset, n):
+        """
+        Read n bytes at offset, the position is not changed
+
+        Returns
+            data, shorter than n at the end of file
+        """
+        size = self.znode.size
+        if offset >= size or n <= 0:
+            return ''
+        n = min(n, size - offset)
+        blk_size = self.blk_size
+        first = offset / blk_size
+        end = (offset + n - 1) / blk_size + 1
+        data = []
+        for blkid, blk in zip(xrange(first, end), self._get_blocks(first, end)):
+            start = max(offset - blkid * blk_size, 0)
+            stop = min(offset + n - blkid * blk_size, blk_size)
+            if blk is HOLE:
+                data.append('\0' * (stop - start))
+            else:
+                data.append(str(blk[start:stop]))
+        return ''.join(data)
+
+    def read(self, n = -1):
+        """
+        Read n bytes from the current position, or up to the end of file
+
+        n is a size, not a queue depth as it used to be, read the whole file
+        with a queue depth of its own by ''.join(f.blocks(queue_depth))
+        """
+        self._checkClosed()
+        if n is None or n < 0:
+            return self.readall()
+        data = self.pread(self.pos, n)
+        self.pos += len(data)
+        return data
+
+    def readall(self):
+        self._checkClosed()
+        if self.pos == 0:
+            data = ''.join(self.blocks())
+        else:
+            data = self.pread(self.pos, self.znode.size - self.pos)
+        self.pos += len(data)
+        return data
+
+    def readinto(self, b):
+        data = self.read(len(b))
+        n = len(data)
+        b[:n] = data
+        return n
+
+    def next_data(self, offset):
+        """
+        Like lseek SEEK_DATA, find the first byte of data at or after offset
+
+        Returns
+            offset, or None if there is no more data
+        """
+        size = self.znode.size
+        if offset >= size:
+            return None
+        blk_size = self.dnode.datablkszsec << 9
+        for blkid, bp in self.dnode.iter_blocks(offset / blk_size):
+            offset = max(offset, blkid * blk_size)
+            if offset < size:
+                return offset
+        return None
+
+    def next_hole(self, offset):
+        """
+        Like lseek SEEK_HOLE, find the first byte of a hole at or after offset,
+        there is always an implicit hole at the end of file
+
+        Returns
+            offset, or None if offset is past the end of file
+        """
+        size = self.znode.size
+        if offset >= size:
+            return None
+        blk_size = self.dnode.datablkszsec << 9
+        hole = self.dnode.next_hole(offset / blk_size) * blk_size
+        return min(size, max(offset, hole))
 
 class ZDir(OODict):
 
     def __init__(self):
         self.entries = None
+        self.zap = None
+
+    def _zap(self):
+        if self.zap is None:
+            self.zap = ZAP(self.dnode.get_blk(0), self.dnode)
+        return self.zap
+
+    def iterdir(self, prefetch = True):
+        """
+        Yield (name, object id, type) of all the entries. A fatzap directory is
+        read a leaf at a time, memory stays bounded whatever its size.
+
+            @prefetch   read the next leaf while this one is decoded
+        """
+        for name, value in self._zap().iteritems(prefetch):
+            yield name, dirent_obj(value), dirent_type(value)
 
     def read(self):
-        bp = self.dnode.blkptr[0]
-        zap = ZAP(ZIO.read_blk(self.dnode.vdev, bp))
-        # I can't find it in the code, but I can tell that the highest 2bits are flags
-        # not part of object id
-        for k, v in zap.entries.items():
-            zap.entries[k] = get_bits(v, 0, 62)
-        self.entries = zap.entries
+        entries = OODict()
+        for name, obj, type in self.iterdir():
+            entries[name] = obj
+        self.entries = entries
 
     def get_child(self, name):
-        # load contents first if haven't 
-        if not self.entries:
-            self.read()
-        if name not in self.entries:
+        # look up by name only, a big fatzap directory is not read in whole
+        if self.entries is not None:
+            return self.entries.get(name)
+        v = self._zap().lookup(name)
+        if v is None:
             return None
-        return self.entries[name]
+        return dirent_obj(v)
 
 
+class ACE(Record('ACE', 'a_who a_access_mask a_flags a_type')):
+    __slots__ = ()
+
+    def __new__(cls, data, offset = 0):
+        return tuple.__new__(cls, ACE_PHYS.unpack_from(data, offset))
+
 class ACL(OODict):
-    def __init__(self, data):
-        f = StreamUnpacker(data)
-        self.z_acl_extern_obj = f.uint64()
-        self.z_acl_count = f.uint32()
-        self.z_acl_version = f.uint16()
+    def __init__(self, data, offset = 0):
+        self.z_acl_extern_obj, self.z_acl_count, self.z_acl_version = ACL_PHYS.unpack_from(data, offset)
 
         self.z_ace_data = []
-        for data in split_records(data[16:], ACL_T_SIZE):
-            acl = OODict()
-            f = StreamUnpacker(data)
-            acl.a_who = f.uint64()
-            acl.a_access_mask = f.uint32()
-            acl.a_flags, acl.a_type = f.repeat('uint16', 2)
-            self.z_ace_data.append(acl)
-
-class ZNode(OODict):
-    def __init__(self, data):
-        f = StreamUnpacker(data[:18*8])
-        self.atime = list(f.repeat('uint64', 2))
-        self.mtime = list(f.repeat('uint64', 2))
-        self.ctime = list(f.repeat('uint64', 2))
-        self.crtime = list(f.repeat('uint64', 2))
-        self.gen, self.mode, self.size, self.parent, \
-        self.links, self.xattr, self.rdev, self.flag,\
-        self.uid, self.gid = f.repeat('uint64', 10)
-
-        self.type = ZPL_FILE_TYPE[get_bits(self.mode, 12, 4)]
-        self.acl = ACL(data[176:])
+        for i in range((len(data) - offset - 16) / ACL_T_SIZE):
+            self.z_ace_data.append(ACE(data, offset + 16 + i * ACL_T_SIZE))
+
+class ZNode(Record('ZNode', 'atime mtime ctime crtime gen mode size parent links xattr rdev flag '
+                             'uid gid type bonus')):
+    """
+    znode_phys_t, times are (seconds, nanoseconds), the ACL is parsed from
+    the bonus when it's asked for. type is None for an unknown mode
+    """
+    __slots__ = ()
+
+    def __new__(cls, data):
+        v = ZNODE_PHYS.unpack_from(data)
+        type = ZPL_FILE_TYPE.get(get_bits(v[9], 12, 4))
+        return tuple.__new__(cls, (v[0:2], v[2:4], v[4:6], v[6:8]) + v[8:18] + (type, data))
+
+    @property
+    def acl(self):
+        return ACL(self.bonus, ZNODE_ACL_OFFSET)
+
+class Stat(Record('Stat', 'st_ino st_mode st_nlink st_uid st_gid st_size st_atime st_mtime '
+                          'st_ctime st_crtime type acl')):
+    """
+    Attributes of an object like os.stat_result, times are seconds in float.
+    acl is None unless asked for
+    """
+    __slots__ = ()
+
+    def __new__(cls, id, data, acl = False):
+        """
+            @data   the znode_phys_t bonus of the object
+        """
+        v = ZNODE_PHYS.unpack_from(data)
+        type = ZPL_FILE_TYPE.get(get_bits(v[9], 12, 4))
+        if acl:
+            acl = ACL(data, ZNODE_ACL_OFFSET)
+        else:
+            acl = None
+        return tuple.__new__(cls, (id, v[9], v[12], v[16], v[17], v[10],
+            v[0] + v[1] / 1e9, v[2] + v[3] / 1e9, v[4] + v[5] / 1e9, v[6] + v[7] / 1e9, type, acl))
 
 class ZFS(object):
     """
@@ -124,7 +377,10 @@ class ZFS(object):
         self.objset = objset
         debug('%s' % objset)
         self.master_node = ZAP.from_dnode(self.objset, 1)
-        self.version = self.master_node.entries.VERSION
+        self.version = self.master_node.lookup('VERSION')
+        self.root = self.master_node.lookup('ROOT')
+        self.queue_depth = conf.queue_depth # blocks a ZFile read keeps in flight
+        self.dentries = LRU(conf.dentry_cache_size) # (parent id, name) -> id, 0 if not found
 
     def open(self, path):
         """
@@ -133,8 +389,6 @@ class ZFS(object):
         Returns:
             File
         """
-        # we use zap read all the children entry at one time, it will be a disaster if there
-        # are hundreds of thousands of entries
         obj_id = self.lookup(path)
         if not obj_id:
             return None
@@ -150,7 +404,7 @@ class ZFS(object):
             f = ZDir()
         else:
             if dnode.type == 'DMU_OT_PLAIN_FILE_CONTENTS':
-                f = ZFile()
+                return ZFile(dnode, znode, self.queue_depth)
             else:
                 return None
         f.dnode = dnode
@@ -160,25 +414,189 @@ class ZFS(object):
     def lookup(self, path):
         """
         Look up a file object id by its path    
+
+        Every name resolved, found or not, is kept in the dentry cache, paths
+        sharing a prefix resolve it only once
         """
         path = normpath(join('/', path))
         debug('lookup %s' % path)
         levels = path.split('/')
         levels.pop(0)
-        id = self.master_node.entries.ROOT
+        id = self.root
         if not levels[0]:
             return id # we are root
         for level in levels:
             parent = id
-            dir = self.open_obj(parent)
-            if not isinstance(dir, ZDir):
-                return None
-            id = dir.get_child(level)
+            id = self.dentries.get((parent, level))
+            if id is None:
+                id = self._get_child(parent, level) or 0
+                self.dentries.put((parent, level), id)
             debug('name: %s id=%s' % (level, id))
             if not id: # not found
                 return None
         return id
 
+    def _get_child(self, parent, name):
+        # only the dnode of the parent is needed, not its znode
+        dnode = self.objset.get_object(parent)
+        if not dnode or dnode.type != 'DMU_OT_DIRECTORY_CONTENTS':
+            return None
+        dir = ZDir()
+        dir.dnode = dnode
+        return dir.get_child(name)
+
+    def readlink(self, id):
+        """
+        Read the target of a symlink, short ones are in the bonus after the
+        znode, longer ones in the data block
+
+        Returns
+            target, or None if id is not a symlink
+        """
+        dnode = self.objset.get_object(id)
+        if not dnode or dnode.bonuslen < ZNODE_SIZE:
+            return None
+        znode = ZNode(dnode.bonus)
+        if znode.type != 'S_IFLNK':
+            return None
+        if ZNODE_SIZE + znode.size <= len(dnode.bonus):
+            return str(dnode.bonus[ZNODE_SIZE:ZNODE_SIZE + znode.size])
+        data = dnode.get_blk(0)
+        if data is None:
+            return None
+        return str(data[:znode.size])
+
+    def stat_many(self, ids, acl = False):
+        """
+        Stat many objects at once. They are grouped by the block of dnodes they
+        live in, each block is read once. Only the dnode header and the znode of
+        an object are decoded, not a whole DNode.
+
+            @acl    parse the ACLs too
+
+        Returns
+            [Stat] in the order of ids, None for the ones without a znode
+        """
+        md = self.objset.meta_dnode
+        object_per_level0blk = (md.datablkszsec << 9) / DNODE_SIZE
+        stats = {}
+        blkid = blk_data = None
+        for id in sorted(set(ids)):
+            if id / object_per_level0blk != blkid:
+                blkid = id / object_per_level0blk
+                blk_data = md.get_blk(blkid)
+            if not blk_data:
+                continue
+            offset = (id % object_per_level0blk) * DNODE_SIZE
+            core = DNODE_PHYS.unpack_from(blk_data, offset)
+            nblkptr, bonustype, bonuslen = core[3], core[4], core[8]
+            if bonustype != DMU_OT_ZNODE or bonuslen < ZNODE_PHYS.size:
+                continue
+            bonus = view(blk_data, offset + DNODE_CORE_SIZE + BlockPtr_SIZE * nblkptr, bonuslen)
+            stats[id] = Stat(id, bonus, acl)
+        return [stats.get(id) for id in ids]
+
+    def scandir(self, path, acl = False):
+        """
+        List a directory with the attributes of its entries. They are stat'ed
+        SCANDIR_BATCH at a time by stat_many, memory stays bounded in big
+        directories.
+
+        Yields
+            (name, Stat)
+        """
+        id = self.lookup(path)
+        if not id:
+            return
+        dir = ZDir()
+        dir.dnode = self.objset.get_object(id)
+        if dir.dnode.type != 'DMU_OT_DIRECTORY_CONTENTS':
+            return
+        batch = []
+        for name, obj, type in dir.iterdir():
+            batch.append((name, obj))
+            if len(batch) >= SCANDIR_BATCH:
+                for item in self._stat_batch(batch, acl):
+                    yield item
+                batch = []
+        for item in self._stat_batch(batch, acl):
+            yield item
+
+    def _stat_batch(self, batch, acl):
+        return zip([name for name, obj in batch], self.stat_many([obj for name, obj in batch], acl))
+
+    def walk(self, path = '/', workers = None, prefetch = True):
+        """
+        Walk the tree under path like os.walk, top down
+
+        Directories are expanded by a pool of workers at the same time, each
+        one is yielded after its parent but the order of siblings' subtrees is
+        not defined. Remove names from dirnames to skip them, like os.walk.
+        Child dnodes are fetched in object id order, siblings sharing a block
+        of dnodes cost one read, they are then in the dnode cache of the objset.
+
+            @workers    directories expanded at the same time, default to
+                        conf.walk_workers
+            @prefetch   fetch the dnodes of files too, not only of directories,
+                        for callers who look at them next
+
+        Yields
+            (dirpath, dirnames, filenames)
+        """
+        if workers is None:
+            workers = conf.walk_workers
+        id = self.lookup(path)
+        if not id:
+            return
+        dnode = self.objset.get_object(id)
+        if not dnode or dnode.type != 'DMU_OT_DIRECTORY_CONTENTS':
+            return # like os.walk, nothing for a file
+        walker.grow(workers)
+        pending = deque([walker.submit(self._expand, normpath(join('/', path)), id, prefetch)])
+        waiting = [] # directories to expand, a stack keeps it small
+        while pending:
+            result = pending.popleft().result()
+            if result:
+                dirpath, dirs, files = result
+                dirnames = [name for name, id in dirs]
+                yield dirpath, dirnames, files
+                ids = dict(dirs)
+                for name in reversed(dirnames):
+                    if name in ids:
+                        waiting.append((join(dirpath, name), ids[name]))
+            while waiting and len(pending) < workers:
+                dirpath, id = waiting.pop()
+                pending.append(walker.submit(self._expand, dirpath, id, prefetch))
+
+    def _expand(self, dirpath, id, prefetch):
+        """
+        Returns
+            (dirpath, [(name, id)] of sub directories, names of other files),
+            None if id is not a directory
+        """
+        dir = ZDir()
+        dir.dnode = self.objset.get_object(id)
+        if not dir.dnode or dir.dnode.type != 'DMU_OT_DIRECTORY_CONTENTS':
+            return None
+        entries = list(dir.iterdir())
+        # no more than the dnode cache holds, or the first ones are evicted
+        # before they are used
+        ids = sorted([obj for name, obj, type in entries if prefetch or type in (None, 'S_IFDIR')])
+        for obj in ids[:self.objset.dnodes.size]:
+            self.objset.get_object(obj)
+        dirs = []
+        files = []
+        for name, obj, type in entries:
+            if type is None: # old entries don't tell, ask the dnode
+                dnode = self.objset.get_object(obj)
+                if dnode and dnode.type == 'DMU_OT_DIRECTORY_CONTENTS':
+                    type = 'S_IFDIR'
+            if type == 'S_IFDIR':
+                dirs.append((name, obj))
+            else:
+                files.append(name)
+        return dirpath, dirs, files
+
     def __repr__(self):
         return '<ZFS>'
 
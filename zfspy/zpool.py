@@ -52,9 +52,50 @@ class ZPool(object):
         # get config, sync_bplist  here
 
         # get root_dataset
-        self.dsl_dir = DSL_Dir(self.mos, self.object_directory.entries.root_dataset)
+        self.dsl_dir = DSL_Dir(self.mos, self.object_directory.lookup('root_dataset'))
 
 
+    def open_fs(self, path = ''):
+        """
+        Open the active filesystem of a dataset, load the pool first
+
+            @path   dataset name relative to the pool, '' is the root dataset
+
+        Returns
+            ZFS, or None if there is no such dataset
+        """
+        dir = self.dsl_dir.lookup_dataset(path)
+        if not dir:
+            return None
+        return dir.head_dataset.active_fs
+
+    @classmethod
+    def open_dataset(cls, name, cf = conf.ZPOOL_CACHE):
+        """
+        Import the pool of dataset 'pool/a/b' from zpool cache, and open its
+        filesystem
+
+        Returns
+            (ZPool, ZFS), None if the pool or dataset isn't found
+        """
+        pool_name, sep, path = name.partition('/')
+        for pool in cls.import_cached(cf) or []:
+            if pool.name == pool_name:
+                pool.load()
+                fs = pool.open_fs(path)
+                if not fs:
+                    print 'dataset %s not found' % name
+                    return None
+                return pool, fs
+        print 'pool %s not found' % pool_name
+        return None
+
+    def close(self):
+        """
+        Close all the devices of this pool
+        """
+        self.spa.close()
+
     def status(self):
         print '  pool:', self.name
         print ' state:', ['ACTIVE', 'EXPORTED', 'DESTROYED'][self.state]
@@ -76,8 +117,7 @@ class ZPool(object):
             return None
 
         pools = []
-        xdr = NVPair.unpack_file(cf)
-        for pool in NVPair.strip(xdr['value']).values():
+        for pool in NVPair.unpack_lazy(open(cf, 'rb').read()).values():
             pools.append(ZPool(pool)) 
         return pools
 